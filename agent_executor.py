@@ -0,0 +1,194 @@
+"""
+Sized executors for blocking agent calls.
+
+Each agent (clarifier, product, customer, engineer, risk, summarizer) gets its
+own pool, so a slow or CPU-bound agent can only exhaust its own workers:
+
+    AGENT_<NAME>_POOL             thread (default) or process
+    AGENT_<NAME>_WORKERS          pool size (default AGENT_WORKERS, 4)
+    AGENT_<NAME>_MAX_CONCURRENCY  calls allowed in flight (default: pool size)
+    AGENT_<NAME>_TIMEOUT          seconds (default AGENT_TIMEOUT, 120)
+
+Calls beyond the concurrency limit wait in the event loop, where the wait is
+measured, instead of piling up invisibly inside the executor. A call that
+times out raises AgentTimeout right away. Threads cannot be interrupted, so
+its slot is only released once the underlying call really returns, which
+keeps the concurrency limit honest.
+"""
+
+import asyncio
+import functools
+import math
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+AGENTS = ("clarifier", "product", "customer", "engineer", "risk", "summarizer")
+
+
+class AgentTimeout(Exception):
+    """An agent call did not finish within its pool's timeout."""
+
+
+class AgentPool:
+    def __init__(
+        self,
+        name: str,
+        kind: str = "thread",
+        max_workers: int = 4,
+        max_concurrency: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ):
+        if kind == "thread":
+            self.executor: Executor = ThreadPoolExecutor(max_workers, thread_name_prefix=f"agent-{name}")
+        elif kind == "process":
+            self.executor = ProcessPoolExecutor(max_workers)
+        else:
+            raise ValueError(f"Unknown pool kind for agent {name}: {kind}")
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency or max_workers
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+
+        self.waiting = 0
+        self.running = 0
+        self.finished = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.run_time_total = 0.0
+        self.run_time_max = 0.0
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run ``fn(*args, **kwargs)`` on this pool and return its result."""
+        loop = asyncio.get_running_loop()
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        started_at = time.perf_counter()
+        wait = started_at - queued_at
+        self.queue_wait_total += wait
+        self.queue_wait_max = max(self.queue_wait_max, wait)
+        self.running += 1
+        try:
+            future = self.executor.submit(functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self.running -= 1
+            self._slots.release()
+            raise
+        # Released from the executor side, so a timed-out call keeps its slot until it ends
+        future.add_done_callback(lambda _: self._call_in_loop(loop, started_at))
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise AgentTimeout(f"Agent {self.name} timed out after {self.timeout}s")
+        except Exception:
+            self.failed += 1
+            raise
+
+    def _call_in_loop(self, loop: asyncio.AbstractEventLoop, started_at: float):
+        try:
+            loop.call_soon_threadsafe(self._release, started_at)
+        except RuntimeError:  # loop already closed at shutdown
+            pass
+
+    def _release(self, started_at: float):
+        elapsed = time.perf_counter() - started_at
+        self.run_time_total += elapsed
+        self.run_time_max = max(self.run_time_max, elapsed)
+        self.running -= 1
+        self.finished += 1
+        self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.finished or 1
+        return {
+            "pool": self.kind,
+            "workers": self.max_workers,
+            "max_concurrency": self.max_concurrency,
+            "waiting": self.waiting,
+            "running": self.running,
+            "finished": self.finished,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "queue_wait_avg_ms": self.queue_wait_total / finished * 1000,
+            "queue_wait_max_ms": self.queue_wait_max * 1000,
+            "run_time_avg_ms": self.run_time_total / finished * 1000,
+            "run_time_max_ms": self.run_time_max * 1000,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AgentExecutor:
+    def __init__(self, pools: Dict[str, AgentPool]):
+        self.pools = pools
+
+    async def run(self, agent: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a blocking agent call on ``agent``'s pool."""
+        return await self.pools[agent].run(fn, *args, **kwargs)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown()
+
+
+def create_agent_executor(agents=AGENTS) -> AgentExecutor:
+    """Build one pool per agent from the AGENT_* environment variables."""
+    default_workers = int(os.environ.get("AGENT_WORKERS", 4))
+    default_timeout = float(os.environ.get("AGENT_TIMEOUT", 120))
+    pools = {}
+    for name in agents:
+        prefix = f"AGENT_{name.upper()}_"
+        max_workers = int(os.environ.get(prefix + "WORKERS", default_workers))
+        max_concurrency = os.environ.get(prefix + "MAX_CONCURRENCY")
+        pools[name] = AgentPool(
+            name,
+            kind=os.environ.get(prefix + "POOL", "thread"),
+            max_workers=max_workers,
+            max_concurrency=int(max_concurrency) if max_concurrency else None,
+            timeout=float(os.environ.get(prefix + "TIMEOUT", default_timeout)),
+        )
+    return AgentExecutor(pools)
+
+
+# --- Mock agents (module level so process pools can pickle them) ---
+def mock_agent(result: Any, seconds: float = 0.0) -> Any:
+    """Blocking agent stand-in that sleeps for ``seconds``."""
+    if seconds:
+        time.sleep(seconds)
+    return result
+
+
+def mock_cpu_agent(result: Any, iterations: int = 100000) -> Any:
+    """Agent stand-in that burns CPU (holds the GIL in a thread pool)."""
+    total = 0.0
+    for i in range(iterations):
+        total += math.sqrt(i)
+    return result
+
+
+async def mock_streaming_agent(text: str, delay: float = 0.0, words_per_chunk: int = 1) -> AsyncIterator[str]:
+    """Streaming agent stand-in: yields ``text`` a few words at a time, like LLM tokens."""
+    words = text.split(" ")
+    for start in range(0, len(words), words_per_chunk):
+        chunk = " ".join(words[start:start + words_per_chunk])
+        yield chunk if start + words_per_chunk >= len(words) else chunk + " "
+        await asyncio.sleep(delay)
+
+
+agent_executor = create_agent_executor()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the Python WebSocket server.
+
+The server's ConnectionManager is driven with real Starlette WebSocket objects
+backed by an in-memory ASGI transport, so no server needs to be running.
+
+    python benchmark.py connections   # connect/disconnect throughput vs. connection count
+    python benchmark.py send          # per-message send cost vs. connection count
+    python benchmark.py broadcast     # room broadcast latency with slow clients
+    python benchmark.py json          # encoder throughput for the merged workflow result
+    python benchmark.py agents        # fast agent latency while a slow agent is saturated
+    python benchmark.py logging       # send throughput with logging off, sampled and unsampled
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+from starlette.websockets import WebSocket
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_socket_server():
+    """Import python-socket-server.py (its file name is not a valid module name)."""
+    sys.path.insert(0, ROOT)
+    spec = importlib.util.spec_from_file_location("socket_server", os.path.join(ROOT, "python-socket-server.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_websocket(send_delay: float = 0.0) -> WebSocket:
+    """Create a WebSocket whose ASGI transport accepts everything in memory."""
+    async def receive():
+        return {"type": "websocket.connect"}
+
+    async def send(message):
+        if send_delay and message["type"] == "websocket.send":
+            await asyncio.sleep(send_delay)
+
+    scope = {"type": "websocket", "path": "/ws/bench", "headers": [], "query_string": b""}
+    return WebSocket(scope, receive, send)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the server's per-message print and logging output."""
+    logging.disable(logging.CRITICAL)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            yield
+        finally:
+            logging.disable(logging.NOTSET)
+
+
+async def bench_connections(server, sizes, batch: int):
+    print(f"{'connections':>12} {'connect/s':>12} {'disconnect/s':>14}")
+    for size in sizes:
+        manager = server.ConnectionManager(max_connections=size + batch)
+        with quiet():
+            for i in range(size):
+                await manager.connect(make_websocket(), f"client_{i}")
+
+            sockets = [make_websocket() for _ in range(batch)]
+            # Keep the cyclic GC from rescanning the pre-populated connections
+            gc.collect()
+            gc.freeze()
+            start = time.perf_counter()
+            for i, websocket in enumerate(sockets):
+                await manager.connect(websocket, f"bench_{i}")
+            connect_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for websocket in sockets:
+                manager.disconnect(websocket)
+            disconnect_time = time.perf_counter() - start
+
+            manager.cleanup_task.cancel()
+            await asyncio.sleep(0)  # let scheduled closes run
+            gc.unfreeze()
+        print(f"{size:>12} {batch / connect_time:>12,.0f} {batch / disconnect_time:>14,.0f}")
+
+
+async def bench_send(server, sizes, messages: int):
+    print(f"{'connections':>12} {'us/message':>12}")
+    message = {"type": "progress", "data": {"message": "Product Response: ..."}}
+    for size in sizes:
+        manager = server.ConnectionManager(max_connections=size)
+        with quiet():
+            sockets = [make_websocket() for _ in range(size)]
+            for i, websocket in enumerate(sockets):
+                await manager.connect(websocket, f"client_{i}")
+            # Let the writers flush the connect/ping messages first
+            while any(len(outbox) for outbox in manager.outboxes.values()):
+                await asyncio.sleep(0.001)
+
+            start = time.perf_counter()
+            for i in range(messages):
+                await manager.send_personal_message(message, sockets[i % size])
+                await asyncio.sleep(0)  # let the writer task send it
+            elapsed = time.perf_counter() - start
+
+            manager.cleanup_task.cancel()
+        print(f"{size:>12} {elapsed / messages * 1e6:>12.1f}")
+
+
+async def bench_broadcast(server, sizes, send_delay: float, slow_fraction: float, send_timeout: float):
+    print(f"{'members':>12} {'queued ms':>12} {'delivered ms':>14} {'evicted':>8}")
+    message = {"type": "receive-message", "data": {"message": "hello room", "roomId": "bench"}}
+    for size in sizes:
+        manager = server.ConnectionManager(max_connections=size)
+        manager.send_timeout = send_timeout
+        slow = max(1, int(size * slow_fraction))
+        with quiet():
+            for i in range(size):
+                # A few clients never drain their socket; the rest have normal network latency
+                delay = 3600.0 if i < slow else send_delay
+                websocket = make_websocket(delay)
+                await websocket.accept()
+                manager.register(websocket, "bench")
+
+            start = time.perf_counter()
+            await manager.broadcast_to_room(message, "bench")
+            queued = time.perf_counter() - start
+            # Wait until every queue is drained or evicted
+            while any(len(outbox) for outbox in manager.outboxes.values()) or any(
+                outbox.sent == 0 for outbox in list(manager.outboxes.values())[slow:]
+            ):
+                await asyncio.sleep(0.001)
+            delivered = time.perf_counter() - start
+            await asyncio.sleep(send_timeout * 1.5)
+        evicted = size - len(manager.rooms.get("bench", {}))
+        print(f"{size:>12} {queued * 1000:>12.1f} {delivered * 1000:>14.1f} {evicted:>8}")
+
+
+def bench_json(iterations: int):
+    sys.path.insert(0, ROOT)
+    import json_codec
+    import main as api
+    from fastapi.encoders import jsonable_encoder
+
+    clarifier = api.ClarifierResponse(resp=[
+        api.ClarifierQuestion(question=question, answer=f"Answer {i}")
+        for i, question in enumerate([
+            "What is the main purpose of your app?",
+            "Who is your target audience?",
+            "What platforms do you want to support (iOS/Android)?",
+            "What is your budget range?",
+            "When do you need it completed?"
+        ])
+    ], done=True)
+    stage_results = api.freeze({
+        "product": api.generate_mock_product_result(),
+        "customer": api.generate_mock_customer_result(),
+        "engineer": api.generate_mock_engineer_result(),
+        "risk": api.generate_mock_risk_result(),
+        "summary": {"summary": api.generate_mock_summary()},
+        "tts": {"tts_file": "https://example.com/speech.mp3"},
+    })
+    clarifier_data = api.freeze(clarifier.model_dump())
+    result = api.merge_workflow_result(clarifier_data, stage_results)
+    state = api.ConversationState(clarifier=clarifier, current_round=3, workflow_started=True, workflow_result=result)
+
+    cases = [
+        ("merged result, json.dumps", lambda: json.dumps(result).encode()),
+        # What a plain `return result` costs even with FastJSONResponse as the default class
+        ("merged result, jsonable_encoder", lambda: json_codec.dumps(jsonable_encoder(result))),
+        ("merged result, json_codec.dumps", lambda: json_codec.dumps(result)),
+        # The stream step events already encoded each stage; only the splice is left
+        ("merged result, cached fragments",
+         lambda: api.encode_workflow_result(clarifier_data.encoded, stage_results, result)),
+        ("state, model_dump() + json.dumps", lambda: json.dumps(state.model_dump()).encode()),
+        ("state, json_codec.dumps", lambda: json_codec.dumps(state)),
+    ]
+    print(f"orjson installed: {json_codec.orjson is not None}")
+    print(f"{'case':<34} {'us/op':>8} {'MB/s':>8}")
+    for name, encode in cases:
+        size = len(encode())
+        start = time.perf_counter()
+        for _ in range(iterations):
+            encode()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<34} {elapsed / iterations * 1e6:>8.1f} {size * iterations / elapsed / 1e6:>8.1f}")
+
+
+async def bench_agents(slow_calls: int, slow_seconds: float, fast_calls: int, workers: int):
+    sys.path.insert(0, ROOT)
+    from concurrent.futures import ThreadPoolExecutor
+    from agent_executor import AgentExecutor, AgentPool, mock_agent
+
+    async def measure(run_slow, run_fast):
+        slow = [asyncio.ensure_future(run_slow()) for _ in range(slow_calls)]
+        await asyncio.sleep(0.01)  # let the slow calls take their workers
+        latencies = []
+        for _ in range(fast_calls):
+            start = time.perf_counter()
+            await run_fast()
+            latencies.append(time.perf_counter() - start)
+        await asyncio.gather(*slow)
+        latencies.sort()
+        return latencies[len(latencies) // 2], latencies[-1]
+
+    # Everything on one shared pool, like asyncio.to_thread on the default executor
+    shared = ThreadPoolExecutor(workers)
+    loop = asyncio.get_running_loop()
+    shared_times = await measure(
+        lambda: loop.run_in_executor(shared, mock_agent, None, slow_seconds),
+        lambda: loop.run_in_executor(shared, mock_agent, None, 0.001),
+    )
+    shared.shutdown()
+
+    executor = AgentExecutor({
+        "risk": AgentPool("risk", max_workers=workers),
+        "product": AgentPool("product", max_workers=workers),
+    })
+    pooled_times = await measure(
+        lambda: executor.run("risk", mock_agent, None, slow_seconds),
+        lambda: executor.run("product", mock_agent, None, 0.001),
+    )
+    executor.shutdown()
+
+    print(f"{slow_calls} slow risk calls ({slow_seconds}s each) on {workers} workers; {fast_calls} product calls")
+    print(f"{'executor':<20} {'p50 ms':>8} {'max ms':>8}")
+    for name, (p50, worst) in (("shared pool", shared_times), ("per-agent pools", pooled_times)):
+        print(f"{name:<20} {p50 * 1000:>8.1f} {worst * 1000:>8.1f}")
+    print(executor.pools["risk"].stats())
+
+
+async def bench_logging(server, connections: int, messages: int, write_delay: float):
+    import structured_log
+
+    message = {"type": "progress", "data": {"message": "Product Response: ..."}}
+    setups = (
+        ("off (level WARNING)", dict(level="WARNING")),
+        ("queued, sampled (defaults)", dict(level="INFO", sample_rate=0.01, rate_limit=100)),
+        ("queued, every message", dict(level="INFO", sample_rate=1.0, rate_limit=0, queue_size=messages * 2)),
+        ("synchronous, every message", None),
+    )
+    print(f"{connections} connections, {messages} messages, {write_delay * 1e6:.0f}us per log write")
+    print(f"{'logging':<30} {'messages/s':>12} {'lines':>8}")
+    with open(os.devnull, "w") as devnull:
+        for name, options in setups:
+            written = [0]
+
+            class CountingStream:
+                def write(self, text):
+                    written[0] += text.count("\n")
+                    if write_delay:
+                        time.sleep(write_delay)  # a terminal or a pipe to a log shipper
+                    return devnull.write(text)
+
+                def flush(self):
+                    devnull.flush()
+
+            if options is not None:
+                structured_log.setup_logging(stream=CountingStream(), **options)
+            else:
+                # Formatting and writing on the loop thread, like logging.basicConfig
+                structured_log.stop_logging()
+                handler = logging.StreamHandler(CountingStream())
+                handler.setFormatter(structured_log.JSONFormatter())
+                logging.getLogger().addHandler(handler)
+                logging.getLogger().setLevel(logging.INFO)
+                structured_log.hot_path.sample_rate = 1.0
+                structured_log.hot_path.limiter = None
+
+            manager = server.ConnectionManager(max_connections=connections)
+            sockets = [make_websocket() for _ in range(connections)]
+            for i, websocket in enumerate(sockets):
+                await manager.connect(websocket, f"client_{i}")
+            while any(len(outbox) for outbox in manager.outboxes.values()):
+                await asyncio.sleep(0.001)
+            written[0] = 0
+
+            start = time.perf_counter()
+            for i in range(messages):
+                await manager.send_personal_message(message, sockets[i % connections])
+                await asyncio.sleep(0)
+            elapsed = time.perf_counter() - start
+
+            structured_log.stop_logging()  # flush, so every line of this run is counted
+            if options is None:
+                logging.getLogger().removeHandler(handler)
+            manager.cleanup_task.cancel()
+            print(f"{name:<30} {messages / elapsed:>12,.0f} {written[0]:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    connections = subparsers.add_parser("connections", help="connect/disconnect throughput vs. connection count")
+    connections.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 20000])
+    connections.add_argument("--batch", type=int, default=1000, help="connections measured per size")
+
+    send = subparsers.add_parser("send", help="per-message send cost vs. connection count")
+    send.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 20000])
+    send.add_argument("--messages", type=int, default=20000)
+
+    broadcast = subparsers.add_parser("broadcast", help="room broadcast latency with slow clients")
+    broadcast.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    broadcast.add_argument("--send-delay", type=float, default=0.005, help="seconds each normal send takes")
+    broadcast.add_argument("--slow-fraction", type=float, default=0.01, help="share of clients that never drain")
+    broadcast.add_argument("--send-timeout", type=float, default=0.25)
+
+    json_parser = subparsers.add_parser("json", help="encoder throughput for the merged workflow result")
+    json_parser.add_argument("--iterations", type=int, default=20000)
+
+    agents = subparsers.add_parser("agents", help="fast agent latency while a slow agent is saturated")
+    agents.add_argument("--slow-calls", type=int, default=16)
+    agents.add_argument("--slow-seconds", type=float, default=0.2)
+    agents.add_argument("--fast-calls", type=int, default=20)
+    agents.add_argument("--workers", type=int, default=4)
+
+    logging_parser = subparsers.add_parser("logging", help="send throughput with logging off, sampled and unsampled")
+    logging_parser.add_argument("--connections", type=int, default=100)
+    logging_parser.add_argument("--messages", type=int, default=20000)
+    logging_parser.add_argument("--write-delay", type=float, default=0.0, help="seconds each log write blocks")
+
+    args = parser.parse_args()
+    if args.benchmark == "json":
+        bench_json(args.iterations)
+        return
+    if args.benchmark == "agents":
+        asyncio.run(bench_agents(args.slow_calls, args.slow_seconds, args.fast_calls, args.workers))
+        return
+    server = load_socket_server()
+
+    if args.benchmark == "connections":
+        asyncio.run(bench_connections(server, args.sizes, args.batch))
+    elif args.benchmark == "send":
+        asyncio.run(bench_send(server, args.sizes, args.messages))
+    elif args.benchmark == "broadcast":
+        asyncio.run(bench_broadcast(server, args.sizes, args.send_delay, args.slow_fraction, args.send_timeout))
+    elif args.benchmark == "logging":
+        asyncio.run(bench_logging(server, args.connections, args.messages, args.write_delay))
+
+
+if __name__ == "__main__":
+    main()
@@ -137,11 +137,8 @@ export default function DashboardContent() {
             throw new Error("Failed to run workflow");
           }
 
-          // Wait a bit for workflow to complete
-          await new Promise((resolve) => setTimeout(resolve, 2000));
-
-          // Get the result
-          const resultResponse = await fetch(`/get_result/${threadId}`);
+          // Get the result; the server holds the request until the workflow completes
+          const resultResponse = await fetch(`/get_result/${threadId}?wait=30`);
           if (!resultResponse.ok) {
             throw new Error("Failed to get workflow result");
           }
@@ -152,7 +152,9 @@ export default function DashboardContent() {
 
       for (const line of lines) {
         try {
-          const data = JSON.parse(line) as WorkflowResponse;
+          // main.py wraps each event as {seq, event} so a dropped stream can resume
+          const parsed = JSON.parse(line);
+          const data = (parsed.event ?? parsed) as WorkflowResponse;
           console.log("Processing workflow step:", data.step);
 
           switch (data.step) {
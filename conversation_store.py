@@ -0,0 +1,441 @@
+"""
+Pluggable storage for conversation state.
+
+``InMemoryStore`` is a bounded LRU/TTL cache for single-worker setups; it
+evicts by idle TTL, entry count and approximate size in bytes.
+``SQLiteStore`` keeps serialized state in a WAL-mode SQLite database so it
+survives restarts and can be shared by several uvicorn workers; writes are
+buffered and flushed in batches by a background thread, so the request path
+never waits on fsync.
+
+``CachedStore`` puts a process-local ``InMemoryStore`` in front of a shared
+store. It is only correct when one process owns each thread (see
+thread_router.py), since other processes' writes never reach the cache.
+
+Expired entries are removed by ``run_sweeper``, a background task that only
+touches the entries it evicts.
+
+Use ``create_store`` to pick a backend from the environment:
+
+    CONVERSATION_STORE        memory (default) or sqlite
+    CONVERSATION_DB_PATH      SQLite file, default conversations.db
+    CONVERSATION_MAX_ENTRIES  in-memory LRU capacity, default 10000
+    CONVERSATION_MAX_BYTES    in-memory size cap (serialized bytes), default 256 MiB
+    CONVERSATION_TTL          idle seconds before a conversation expires, default 3600
+    CONVERSATION_SWEEP_INTERVAL  seconds between expiry sweeps, default 30
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Set
+
+
+class ConversationStore(ABC):
+    """Key/value store for conversation state, keyed by thread_id."""
+
+    @abstractmethod
+    def get(self, thread_id: str) -> Optional[Any]:
+        """Return the state for ``thread_id`` or None if it does not exist."""
+
+    @abstractmethod
+    def put(self, thread_id: str, state: Any) -> None:
+        """Create or replace the state for ``thread_id``."""
+
+    @abstractmethod
+    def delete(self, thread_id: str) -> None:
+        """Remove ``thread_id`` if present."""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    def __contains__(self, thread_id: str) -> bool:
+        return self.get(thread_id) is not None
+
+    def touch(self, thread_id: str) -> None:
+        """Count ``thread_id`` as accessed (for idle expiry) without reading it."""
+
+    def sweep(self) -> None:
+        """Evict expired entries."""
+
+    def stats(self) -> Dict[str, Any]:
+        """Entry count, approximate memory use and eviction counters."""
+        return {"entries": len(self)}
+
+    def close(self) -> None:
+        """Release resources and persist any buffered writes."""
+
+
+class InMemoryStore(ConversationStore):
+    """Process-local LRU store with idle TTL, entry cap and byte cap.
+
+    ``sizeof`` estimates the size of a state (e.g. its serialized length); it
+    is called once per ``put`` and drives both ``max_bytes`` and the memory
+    figure reported by ``stats``.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Optional[Callable[[Any], int]] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        # thread_id -> (state, last_access, size), least recently used first
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.approx_bytes = 0
+        self.evicted_expired = 0
+        self.evicted_capacity = 0
+
+    def get(self, thread_id: str) -> Optional[Any]:
+        entry = self._entries.get(thread_id)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if self.ttl is not None and now - entry[1] > self.ttl:
+            self._remove(thread_id)
+            self.evicted_expired += 1
+            return None
+        self._entries[thread_id] = (entry[0], now, entry[2])
+        self._entries.move_to_end(thread_id)
+        return entry[0]
+
+    def put(self, thread_id: str, state: Any) -> None:
+        size = self.sizeof(state) if self.sizeof else 0
+        self._remove(thread_id)
+        self._entries[thread_id] = (state, time.monotonic(), size)
+        self.approx_bytes += size
+        self._evict_over_capacity()
+
+    def delete(self, thread_id: str) -> None:
+        self._remove(thread_id)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def sweep(self) -> None:
+        if self.ttl is None:
+            return
+        deadline = time.monotonic() - self.ttl
+        # Oldest entries sit at the front, so this only touches what it removes
+        while self._entries:
+            thread_id, entry = next(iter(self._entries.items()))
+            if entry[1] >= deadline:
+                break
+            self._remove(thread_id)
+            self.evicted_expired += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "approx_bytes": self.approx_bytes,
+            "evicted_expired": self.evicted_expired,
+            "evicted_capacity": self.evicted_capacity,
+        }
+
+    def _remove(self, thread_id: str) -> None:
+        entry = self._entries.pop(thread_id, None)
+        if entry is not None:
+            self.approx_bytes -= entry[2]
+
+    def _evict_over_capacity(self) -> None:
+        # Each entry is evicted at most once, so this is amortized O(1) per put.
+        # The entry just written is never evicted, even if it alone exceeds max_bytes.
+        while len(self._entries) > 1 and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.approx_bytes > self.max_bytes)
+        ):
+            self._remove(next(iter(self._entries)))
+            self.evicted_capacity += 1
+
+
+class SQLiteStore(ConversationStore):
+    """SQLite (WAL) store with batched write-behind.
+
+    ``encode``/``decode`` convert state to and from the stored text. ``put``
+    and ``delete`` only record the change in a pending buffer; a writer thread
+    commits the buffer every ``flush_interval`` seconds in one transaction.
+    Reads consult the pending buffer first, so a worker always sees its own
+    writes.
+
+    Expiry is by idle time, as in ``InMemoryStore``: reads are recorded and
+    their ``updated_at`` is refreshed with the next batch. ``len()`` is the
+    row count taken by the writer thread (at most ``count_interval`` seconds
+    after this process's last write), so /health and /metrics never run a
+    COUNT on the event loop.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        encode: Callable[[Any], str],
+        decode: Callable[[str], Any],
+        table: str = "conversations",
+        flush_interval: float = 0.05,
+        ttl: Optional[float] = None,
+        count_interval: float = 1.0,
+    ):
+        self.path = path
+        self.encode = encode
+        self.decode = decode
+        self.table = table
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.count_interval = count_interval
+
+        # Changes not yet committed; _flushing holds the batch being committed
+        self._pending: Dict[str, Optional[str]] = {}
+        self._flushing: Dict[str, Optional[str]] = {}
+        # Threads read since the last flush, whose updated_at is refreshed with it
+        self._touched: Set[str] = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._sweep_due = False
+        self.evicted_expired = 0
+
+        self._reader = self._connect()
+        self._reader.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "thread_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._reader.execute(f"CREATE INDEX IF NOT EXISTS {table}_updated_at ON {table} (updated_at)")
+        self._reader.commit()
+        self._writer_conn = self._connect()
+        self._count = self._writer_conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        self._count_stale = False
+        self._counted_at = time.monotonic()
+
+        self._writer = threading.Thread(target=self._write_loop, name=f"{table}-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, thread_id: str) -> Optional[Any]:
+        with self._lock:
+            for buffered in (self._pending, self._flushing):
+                if thread_id in buffered:
+                    encoded = buffered[thread_id]
+                    return None if encoded is None else self.decode(encoded)
+
+        query = f"SELECT state FROM {self.table} WHERE thread_id = ?"
+        params: tuple = (thread_id,)
+        if self.ttl is not None:
+            query += " AND updated_at >= ?"
+            params += (time.time() - self.ttl,)
+        row = self._reader.execute(query, params).fetchone()
+        if row is None:
+            return None
+        self.touch(thread_id)
+        return self.decode(row[0])
+
+    def touch(self, thread_id: str) -> None:
+        if self.ttl is not None:
+            with self._lock:
+                self._touched.add(thread_id)
+            self._wakeup.set()
+
+    def put(self, thread_id: str, state: Any) -> None:
+        encoded = self.encode(state)
+        with self._lock:
+            self._pending[thread_id] = encoded
+        self._wakeup.set()
+
+    def delete(self, thread_id: str) -> None:
+        with self._lock:
+            self._pending[thread_id] = None
+        self._wakeup.set()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def flush(self) -> None:
+        """Commit all pending writes now (blocking)."""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._flushing = self._pending
+                self._pending = {}
+                touched, self._touched = self._touched, set()
+            try:
+                if batch or touched:
+                    self._commit(batch, touched.difference(batch))
+                    self._count_stale = self._count_stale or bool(batch)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def _commit(self, batch: Dict[str, Optional[str]], touched: Set[str] = frozenset()) -> None:
+        now = time.time()
+        upserts = [(thread_id, encoded, now) for thread_id, encoded in batch.items() if encoded is not None]
+        deletes = [(thread_id,) for thread_id, encoded in batch.items() if encoded is None]
+        with self._writer_conn:
+            if touched:
+                self._writer_conn.executemany(
+                    f"UPDATE {self.table} SET updated_at = ? WHERE thread_id = ?",
+                    [(now, thread_id) for thread_id in touched],
+                )
+            if upserts:
+                self._writer_conn.executemany(
+                    f"INSERT INTO {self.table} (thread_id, state, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(thread_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                    upserts,
+                )
+            if deletes:
+                self._writer_conn.executemany(f"DELETE FROM {self.table} WHERE thread_id = ?", deletes)
+
+    def _write_loop(self) -> None:
+        while not self._closed:
+            # While a recount is owed, wake up for it even if nothing else happens
+            self._wakeup.wait(self.count_interval if self._count_stale else None)
+            self._wakeup.clear()
+            # Let more writes accumulate so they share one transaction
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if self._sweep_due:
+                    self._sweep_due = False
+                    self._delete_expired()
+                if self._count_stale and time.monotonic() - self._counted_at >= self.count_interval:
+                    self._recount()
+            except sqlite3.Error as e:
+                print(f"Error flushing {self.table}: {e}")
+
+    def sweep(self) -> None:
+        # Runs on the writer thread so the caller never blocks on the DELETE
+        if self.ttl is not None:
+            self._sweep_due = True
+            self._wakeup.set()
+
+    def _delete_expired(self) -> None:
+        with self._flush_lock, self._writer_conn:
+            cursor = self._writer_conn.execute(
+                f"DELETE FROM {self.table} WHERE updated_at < ?", (time.time() - self.ttl,)
+            )
+            self.evicted_expired += cursor.rowcount
+            self._count_stale = self._count_stale or cursor.rowcount > 0
+
+    def _recount(self) -> None:
+        with self._flush_lock:
+            self._count = self._writer_conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        self._count_stale = False
+        self._counted_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        page_count = self._reader.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self._reader.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "entries": len(self),
+            "approx_bytes": page_count * page_size,
+            "evicted_expired": self.evicted_expired,
+        }
+
+    def close(self) -> None:
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        self.flush()
+        self._writer_conn.close()
+        self._reader.close()
+
+
+class CachedStore(ConversationStore):
+    """Write-through cache: reads are served from ``local`` and only go to ``shared`` on a miss."""
+
+    def __init__(self, local: InMemoryStore, shared: ConversationStore):
+        self.local = local
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, thread_id: str) -> Optional[Any]:
+        state = self.local.get(thread_id)
+        if state is not None:
+            self.hits += 1
+            self.shared.touch(thread_id)  # keeps the shared copy from expiring under a busy thread
+            return state
+        self.misses += 1
+        state = self.shared.get(thread_id)
+        if state is not None:
+            self.local.put(thread_id, state)
+        return state
+
+    def put(self, thread_id: str, state: Any) -> None:
+        self.local.put(thread_id, state)
+        self.shared.put(thread_id, state)
+
+    def delete(self, thread_id: str) -> None:
+        self.local.delete(thread_id)
+        self.shared.delete(thread_id)
+
+    def __len__(self) -> int:
+        return len(self.shared)
+
+    def sweep(self) -> None:
+        self.local.sweep()
+        self.shared.sweep()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.shared.stats(), "cache": {**self.local.stats(), "hits": self.hits, "misses": self.misses}}
+
+    def close(self) -> None:
+        self.shared.close()
+
+
+def create_store(
+    encode: Callable[[Any], str],
+    decode: Callable[[str], Any],
+    table: str = "conversations",
+    local_cache: bool = False,
+) -> ConversationStore:
+    """Build the conversation store selected by the CONVERSATION_* environment variables.
+
+    With ``local_cache``, a shared (SQLite) store gets an in-memory
+    ``CachedStore`` in front; only use it when each thread has a single
+    owning process.
+    """
+    backend = os.environ.get("CONVERSATION_STORE", "memory").lower()
+    ttl = float(os.environ.get("CONVERSATION_TTL", 3600))
+
+    def memory_store() -> InMemoryStore:
+        return InMemoryStore(
+            max_entries=int(os.environ.get("CONVERSATION_MAX_ENTRIES", 10000)),
+            ttl=ttl,
+            max_bytes=int(os.environ.get("CONVERSATION_MAX_BYTES", 256 * 1024 * 1024)),
+            sizeof=lambda state: len(encode(state)),
+        )
+
+    if backend == "sqlite":
+        path = os.environ.get("CONVERSATION_DB_PATH", "conversations.db")
+        store = SQLiteStore(path, encode, decode, table=table, ttl=ttl)
+        return CachedStore(memory_store(), store) if local_cache else store
+    if backend == "memory":
+        return memory_store()
+    raise ValueError(f"Unknown CONVERSATION_STORE backend: {backend}")
+
+
+async def run_sweeper(store: ConversationStore, interval: Optional[float] = None) -> None:
+    """Periodically evict expired entries from ``store``; run as a background task."""
+    if interval is None:
+        interval = float(os.environ.get("CONVERSATION_SWEEP_INTERVAL", 30))
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            store.sweep()
+        except Exception as e:
+            print(f"Error sweeping conversation store: {e}")
@@ -1,14 +1,20 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import json
+import os
 import uuid
+import asyncio
 import time
 from typing import Dict, Any, List, Optional
 from fastapi.middleware.cors import CORSMiddleware
 
+import json_codec
+from json_codec import FastJSONResponse
+from conversation_store import create_store, run_sweeper
+from job_engine import JobEngine
 
-app = FastAPI(title="Product Conversation API")
+
+app = FastAPI(title="Product Conversation API", default_response_class=FastJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
@@ -17,8 +23,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory storage for conversation states
-conversation_states: Dict[str, Dict[str, Any]] = {}
+# Conversation states (in-memory or SQLite, see conversation_store.py)
+conversation_states = create_store(encode=json_codec.dumps_str, decode=json_codec.loads, table="conversation_states")
+
+sweeper_tasks: List[asyncio.Task] = []
+
+# Background workflows; at most WORKFLOW_WORKERS run at once (see job_engine.py)
+workflow_jobs = JobEngine(
+    max_workers=int(os.environ.get("WORKFLOW_WORKERS", 4)),
+    default_timeout=float(os.environ.get("WORKFLOW_TIMEOUT", 300))
+)
+
+# Upper bound for /get_result?wait=, in seconds
+MAX_RESULT_WAIT = float(os.environ.get("MAX_RESULT_WAIT", 30))
+
+@app.on_event("startup")
+async def start_background_tasks():
+    sweeper_tasks.append(asyncio.create_task(run_sweeper(conversation_states)))
+    sweeper_tasks.append(asyncio.create_task(run_sweeper(workflow_jobs.jobs)))
+    await workflow_jobs.start()
+
+@app.on_event("shutdown")
+async def close_conversation_states():
+    await workflow_jobs.stop()
+    for task in sweeper_tasks:
+        task.cancel()
+    conversation_states.close()
 
 # Pydantic models for request/response
 class TextInput(BaseModel):
@@ -44,12 +74,13 @@ def generate_thread_id() -> str:
     return str(uuid.uuid4())
 
 def get_conversation_state(thread_id: str) -> Dict[str, Any]:
-    if thread_id not in conversation_states:
+    state = conversation_states.get(thread_id)
+    if state is None:
         raise HTTPException(status_code=404, detail="Thread not found")
-    return conversation_states[thread_id]
+    return state
 
 def update_conversation_state(thread_id: str, state: Dict[str, Any]) -> None:
-    conversation_states[thread_id] = state
+    conversation_states.put(thread_id, state)
 
 # API Endpoints
 @app.post("/start_conversation")
@@ -73,7 +104,7 @@ async def start_conversation(request: StartConversationRequest):
     # Add initial clarifier message
     state["messages"].append({
         "role": "assistant",
-        "content": json.dumps({
+        "content": json_codec.dumps_str({
             "resp": [
                 {"question": "What is your primary goal with this product?", "answer": None},
                 {"question": "Who is your target audience?", "answer": None}
@@ -105,7 +136,7 @@ async def continue_clarifier(request: ContinueClarifierRequest):
     try:
         # Get the last clarifier message
         last_message = state["messages"][-1]
-        clarifier_data = json.loads(last_message["content"])
+        clarifier_data = json_codec.loads(last_message["content"])
         
         # Update with user answers
         if "resp" in clarifier_data:
@@ -128,7 +159,7 @@ async def continue_clarifier(request: ContinueClarifierRequest):
                 
                 state["messages"].append({
                     "role": "assistant",
-                    "content": json.dumps({
+                    "content": json_codec.dumps_str({
                         "resp": next_questions,
                         "done": False
                     })
@@ -140,7 +171,7 @@ async def continue_clarifier(request: ContinueClarifierRequest):
                 # Mark clarifier as done
                 state["messages"].append({
                     "role": "assistant",
-                    "content": json.dumps({
+                    "content": json_codec.dumps_str({
                         "resp": [],
                         "done": True
                     })
@@ -172,7 +203,7 @@ async def get_state(thread_id: str):
         "current_round": state.get("current_round", 0)
     }
     
-    return response_state
+    return FastJSONResponse(response_state)
 
 @app.post("/run_workflow")
 async def run_workflow(request: RunWorkflowRequest):
@@ -184,35 +215,50 @@ async def run_workflow(request: RunWorkflowRequest):
         raise HTTPException(status_code=400, detail="Clarifier conversation not completed")
     
     # Run the workflow in the background
-    background_tasks = BackgroundTasks()
-    background_tasks.add_task(run_workflow_background, request.thread_id)
+    try:
+        job = workflow_jobs.submit(request.thread_id, lambda: run_workflow_background(request.thread_id))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    # Forget the previous run, so get_result doesn't serve it as this run's result
+    state.pop("workflow_error", None)
+    state["workflow_done"] = False
+    for _, data in WORKFLOW_STEPS:
+        for field in data:
+            state["final_data"].pop(field, None)
+    state["workflow_progress"] = {"step": None, "completed": 0, "total": len(WORKFLOW_STEPS)}
+    update_conversation_state(request.thread_id, state)
     
     return {
         "status": "workflow_started",
-        "thread_id": request.thread_id
+        "thread_id": request.thread_id,
+        "job": job.status
     }
 
+# (step, fields it adds to final_data), in execution order
+WORKFLOW_STEPS = [
+    ("product", {
+        "product": {"name": "Sample Product", "features": ["Feature 1", "Feature 2"]},
+        "diagram_url": "https://example.com/diagram.png"
+    }),
+    ("customer", {"customer": {"segment": "Enterprise", "needs": ["Need 1", "Need 2"]}}),
+    ("engineer", {"engineer": {"feasibility": "High", "timeline": "6 months"}}),
+    ("risk", {"risk": {"level": "Medium", "mitigations": ["Mitigation 1", "Mitigation 2"]}}),
+    ("summary", {"summary": "This is a summary of the product analysis."}),
+    ("tts", {"tts_file": "https://example.com/speech.mp3"}),
+]
+
 async def run_workflow_background(thread_id: str):
-    """Run the workflow in the background"""
+    """Run the workflow in the background, recording progress after each step"""
     state = get_conversation_state(thread_id)
     
     try:
         # Simulate running the workflow steps
-        state["final_data"]["product"] = {"name": "Sample Product", "features": ["Feature 1", "Feature 2"]}
-        state["final_data"]["diagram_url"] = "https://example.com/diagram.png"
-        
-        state["final_data"]["customer"] = {"segment": "Enterprise", "needs": ["Need 1", "Need 2"]}
-        
-        state["final_data"]["engineer"] = {"feasibility": "High", "timeline": "6 months"}
-        
-        state["final_data"]["risk"] = {"level": "Medium", "mitigations": ["Mitigation 1", "Mitigation 2"]}
-        
-        # Generate final summary
-        summary = "This is a summary of the product analysis."
-        state["final_data"]["summary"] = summary
-        
-        # Convert summary to speech (simulated)
-        state["final_data"]["tts_file"] = "https://example.com/speech.mp3"
+        for completed, (step, data) in enumerate(WORKFLOW_STEPS, 1):
+            state["final_data"].update(data)
+            state["workflow_progress"] = {"step": step, "completed": completed, "total": len(WORKFLOW_STEPS)}
+            update_conversation_state(thread_id, state)
+            await asyncio.sleep(0)  # let other requests run between steps
         
         # Update state to mark workflow as done
         state["workflow_done"] = True
@@ -223,14 +269,25 @@ async def run_workflow_background(thread_id: str):
         update_conversation_state(thread_id, state)
 
 @app.get("/get_result/{thread_id}")
-async def get_result(thread_id: str):
-    """Get the final result of the workflow"""
+async def get_result(thread_id: str, wait: float = 0):
+    """Get the final result of the workflow, waiting up to `wait` seconds for it"""
     state = get_conversation_state(thread_id)
     
+    job = workflow_jobs.get(thread_id)
+    if job is not None and not job.done and wait > 0:
+        await job.wait(min(wait, MAX_RESULT_WAIT))
+        state = get_conversation_state(thread_id)
+    
     if not state.get("workflow_done", False):
         if "workflow_error" in state:
             raise HTTPException(status_code=500, detail=f"Workflow failed: {state['workflow_error']}")
-        raise HTTPException(status_code=404, detail="Workflow result not available yet")
+        if job is not None and job.done and job.error:
+            raise HTTPException(status_code=500, detail=f"Workflow {job.status}: {job.error}")
+        raise HTTPException(status_code=404, detail={
+            "message": "Workflow result not available yet",
+            "status": job.status if job is not None else None,
+            "progress": state.get("workflow_progress")
+        })
     
     # Return the final data
     result = {
@@ -238,7 +295,7 @@ async def get_result(thread_id: str):
         "summary": state["final_data"].get("summary", "")
     }
     
-    return result
+    return FastJSONResponse(result)
 
 @app.post("/run_workflow_stream")
 async def run_workflow_stream(request: RunWorkflowStreamRequest):
@@ -263,7 +320,7 @@ async def run_workflow_stream(request: RunWorkflowStreamRequest):
     async def generate_stream():
         try:
             # Step 1: Start
-            yield json.dumps({
+            yield json_codec.dumps({
                 "step": "start",
                 "status": "success",
                 "data": {
@@ -272,7 +329,7 @@ async def run_workflow_stream(request: RunWorkflowStreamRequest):
                 },
                 "thread_id": thread_id,
                 "timestamp": time.time()
-            }) + "\n"
+            }) + b"\n"
             
             # Step 2: Run clarifier (simulated)
             clarifier_data = {
@@ -285,20 +342,20 @@ async def run_workflow_stream(request: RunWorkflowStreamRequest):
             
             state["final_data"]["clarifier"] = clarifier_data
             
-            yield json.dumps({
+            yield json_codec.dumps({
                 "step": "clarifier",
                 "status": "success",
                 "data": clarifier_data,
                 "error": None,
                 "thread_id": thread_id,
                 "timestamp": time.time()
-            }) + "\n"
+            }) + b"\n"
             
             # Step 3: Run product agent
             state["final_data"]["product"] = {"name": "Sample Product", "features": ["Feature 1", "Feature 2"]}
             state["final_data"]["diagram_url"] = "https://example.com/diagram.png"
             
-            yield json.dumps({
+            yield json_codec.dumps({
                 "step": "product",
                 "status": "success",
                 "data": {
@@ -308,68 +365,68 @@ async def run_workflow_stream(request: RunWorkflowStreamRequest):
                 "error": None,
                 "thread_id": thread_id,
                 "timestamp": time.time()
-            }) + "\n"
+            }) + b"\n"
             
             # Step 4: Run customer agent
             state["final_data"]["customer"] = {"segment": "Enterprise", "needs": ["Need 1", "Need 2"]}
             
-            yield json.dumps({
+            yield json_codec.dumps({
                 "step": "customer",
                 "status": "success",
                 "data": state["final_data"]["customer"],
                 "error": None,
                 "thread_id": thread_id,
                 "timestamp": time.time()
-            }) + "\n"
+            }) + b"\n"
             
             # Step 5: Run engineer agent
             state["final_data"]["engineer"] = {"feasibility": "High", "timeline": "6 months"}
             
-            yield json.dumps({
+            yield json_codec.dumps({
                 "step": "engineer",
                 "status": "success",
                 "data": state["final_data"]["engineer"],
                 "error": None,
                 "thread_id": thread_id,
                 "timestamp": time.time()
-            }) + "\n"
+            }) + b"\n"
             
             # Step 6: Run risk agent
             state["final_data"]["risk"] = {"level": "Medium", "mitigations": ["Mitigation 1", "Mitigation 2"]}
             
-            yield json.dumps({
+            yield json_codec.dumps({
                 "step": "risk",
                 "status": "success",
                 "data": state["final_data"]["risk"],
                 "error": None,
                 "thread_id": thread_id,
                 "timestamp": time.time()
-            }) + "\n"
+            }) + b"\n"
             
             # Step 7: Generate summary
             summary = "This is a summary of the product analysis."
             state["final_data"]["summary"] = summary
             
-            yield json.dumps({
+            yield json_codec.dumps({
                 "step": "summary",
                 "status": "success",
                 "data": {"summary": summary},
                 "error": None,
                 "thread_id": thread_id,
                 "timestamp": time.time()
-            }) + "\n"
+            }) + b"\n"
             
             # Step 8: Convert to speech
             state["final_data"]["tts_file"] = "https://example.com/speech.mp3"
             
-            yield json.dumps({
+            yield json_codec.dumps({
                 "step": "tts",
                 "status": "success",
                 "data": {"tts_file": state["final_data"]["tts_file"]},
                 "error": None,
                 "thread_id": thread_id,
                 "timestamp": time.time()
-            }) + "\n"
+            }) + b"\n"
             
             # Final result
             result = {
@@ -377,25 +434,25 @@ async def run_workflow_stream(request: RunWorkflowStreamRequest):
                 "summary": summary
             }
             
-            yield json.dumps(result) + "\n"
+            yield json_codec.dumps(result) + b"\n"
             
             # Update state to mark workflow as done
             state["workflow_done"] = True
             update_conversation_state(thread_id, state)
         except Exception as e:
-            yield json.dumps({
+            yield json_codec.dumps({
                 "step": "error",
                 "status": "error",
                 "error": str(e),
                 "thread_id": thread_id,
                 "timestamp": time.time()
-            }) + "\n"
+            }) + b"\n"
     
     return StreamingResponse(
         generate_stream(),
         media_type="application/json"
     )
 
-if __name__ == "_main_":
+if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
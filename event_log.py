@@ -0,0 +1,80 @@
+"""
+Per-thread append-only log of NDJSON workflow events.
+
+Every event gets a sequence number (1, 2, ...) and is encoded once when it is
+appended, as an envelope line ``{"seq": n, "event": {...}}``; the event itself
+(the final result included) goes out exactly as the endpoints return it.
+Readers replay the events after a given sequence number and then tail new
+ones until the log is closed, so a client that reconnects only costs a
+replay, never a rerun of the pipeline.
+"""
+
+import asyncio
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+
+import json_codec
+from conversation_store import InMemoryStore
+
+
+class EventLog:
+    def __init__(self, thread_id: str):
+        self.thread_id = thread_id
+        self.lines: List[bytes] = []
+        self.closed = False
+        self._appended = asyncio.Event()
+
+    @property
+    def last_seq(self) -> int:
+        return len(self.lines)
+
+    def append(self, event: Union[Dict[str, Any], bytes]) -> int:
+        """Wrap ``event`` in an envelope with the next sequence number and wake readers.
+
+        ``event`` may also be an already-encoded JSON object, which is used
+        as-is.
+        """
+        seq = len(self.lines) + 1
+        if not isinstance(event, bytes):
+            event = json_codec.dumps(event)
+        line = json_codec.encode_fields({"seq": b"%d" % seq, "event": event})
+        self.lines.append(line + b"\n")
+        self._notify()
+        return seq
+
+    def close(self):
+        self.closed = True
+        self._notify()
+
+    def _notify(self):
+        # Each waiter holds the event current at the time it started waiting
+        self._appended.set()
+        self._appended = asyncio.Event()
+
+    async def tail(self, after_seq: int = 0) -> AsyncIterator[bytes]:
+        """Yield the lines after ``after_seq``, then new ones until the log closes."""
+        index = max(0, after_seq)
+        while True:
+            while index < len(self.lines):
+                yield self.lines[index]
+                index += 1
+            if self.closed:
+                return
+            await self._appended.wait()
+
+
+# Logs stay available for reconnects until they have been idle for EVENT_LOG_TTL seconds
+event_logs = InMemoryStore(
+    max_entries=int(os.environ.get("EVENT_LOG_MAX_ENTRIES", 10000)),
+    ttl=float(os.environ.get("EVENT_LOG_TTL", 3600))
+)
+
+
+def create_event_log(thread_id: str) -> EventLog:
+    log = EventLog(thread_id)
+    event_logs.put(thread_id, log)
+    return log
+
+
+def get_event_log(thread_id: str) -> Optional[EventLog]:
+    return event_logs.get(thread_id)
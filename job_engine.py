@@ -0,0 +1,188 @@
+"""
+In-process background job engine.
+
+Jobs are coroutine factories run by a fixed pool of worker tasks, so at most
+``max_workers`` jobs execute at once per process. Queued jobs are ordered by
+priority (lower runs first, FIFO within a priority). Every job is tracked by
+id, can be cancelled while queued or running, and is stopped after its
+timeout. Finished jobs stay queryable until they have been idle for
+``retention`` seconds.
+"""
+
+import asyncio
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from conversation_store import InMemoryStore
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMED_OUT = "timed_out"
+
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED, TIMED_OUT)
+
+
+class Job:
+    def __init__(self, job_id: str, fn: Callable[[], Awaitable[Any]], priority: int, timeout: Optional[float]):
+        self.id = job_id
+        self.fn = fn
+        self.priority = priority
+        self.timeout = timeout
+        self.status = QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self._finished = asyncio.Event()
+        self._callbacks: List[Callable[["Job"], None]] = []
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def add_done_callback(self, callback: Callable[["Job"], None]):
+        """Call ``callback(job)`` once the job finishes, whatever its outcome."""
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the job to finish; returns False if ``timeout`` expired first."""
+        try:
+            await asyncio.wait_for(self._finished.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def cancel(self) -> bool:
+        if self.done:
+            return False
+        if self.task is not None:
+            self.task.cancel()
+        else:
+            # Still queued; the worker skips it when it is dequeued
+            self._finish(CANCELLED)
+        return True
+
+    def _finish(self, status: str, result: Any = None, error: Optional[str] = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self._finished.set()
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Error in job {self.id} callback: {e}")
+        self._callbacks.clear()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class JobEngine:
+    def __init__(self, max_workers: int = 4, default_timeout: Optional[float] = None, retention: float = 3600):
+        self.max_workers = max_workers
+        self.default_timeout = default_timeout
+        self.jobs = InMemoryStore(ttl=retention)  # job id -> Job
+        self._active: Dict[str, Job] = {}  # queued and running jobs, never evicted
+        self._queue: "asyncio.PriorityQueue" = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._workers: List[asyncio.Task] = []
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_workers)]
+
+    async def stop(self):
+        for job in list(self._active.values()):
+            job.cancel()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(
+        self,
+        job_id: str,
+        fn: Callable[[], Awaitable[Any]],
+        priority: int = 0,
+        timeout: Optional[float] = None
+    ) -> Job:
+        """Queue ``fn()`` to run as job ``job_id``; replaces a finished job with the same id."""
+        existing = self.get(job_id)
+        if existing is not None and not existing.done:
+            raise ValueError(f"Job {job_id} is already {existing.status}")
+
+        job = Job(job_id, fn, priority, timeout if timeout is not None else self.default_timeout)
+        self._active[job_id] = job
+        self.jobs.put(job_id, job)
+        job.add_done_callback(lambda finished: self._active.pop(finished.id, None))
+        self._queue.put_nowait((priority, next(self._order), job))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._active.get(job_id) or self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        return job.cancel() if job is not None else False
+
+    def stats(self) -> Dict[str, Any]:
+        running = sum(1 for job in self._active.values() if job.status == RUNNING)
+        return {
+            "workers": self.max_workers,
+            "queued": len(self._active) - running,
+            "running": running,
+            "completed": self.completed,
+            "failed": self.failed
+        }
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            if job.done:  # cancelled while queued
+                continue
+
+            job.status = RUNNING
+            job.started_at = time.time()
+            started = time.monotonic()
+            job.task = asyncio.create_task(asyncio.wait_for(job.fn(), job.timeout))
+            # Wait without propagating the job's cancellation into the worker
+            await asyncio.wait({job.task})
+            elapsed = time.monotonic() - started
+
+            error = None if job.task.cancelled() else job.task.exception()
+            if job.task.cancelled():
+                job._finish(CANCELLED)
+            elif isinstance(error, asyncio.TimeoutError) and job.timeout is not None and elapsed >= job.timeout:
+                job._finish(TIMED_OUT, error=f"Job timed out after {job.timeout}s")
+            elif error is not None:
+                # Includes timeouts raised inside the job (an agent call, its
+                # own wait_for) before the job's deadline was reached
+                job._finish(FAILED, error=str(error) or type(error).__name__)
+            else:
+                job._finish(SUCCEEDED, result=job.task.result())
+
+            if job.status == SUCCEEDED:
+                self.completed += 1
+            else:
+                self.failed += 1
@@ -0,0 +1,81 @@
+"""
+Shared JSON encoding for the HTTP APIs and the WebSocket server.
+
+Uses orjson when it is installed and falls back to the standard library
+otherwise; both produce compact output. Pydantic models are serialized by
+pydantic's own JSON serializer instead of being converted to a dict first.
+"""
+
+import json
+from typing import Any, Mapping
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # orjson is optional
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        # Fragment embeds pydantic's JSON as-is (orjson >= 3.9)
+        if orjson is not None and hasattr(orjson, "Fragment"):
+            return orjson.Fragment(obj.model_dump_json())
+        return obj.model_dump(mode="json")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode ``obj`` as compact UTF-8 JSON bytes."""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump_json().encode()
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def dumps_str(obj: Any) -> str:
+    """Encode ``obj`` as a compact JSON string (e.g. for WebSocket text frames)."""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump_json()
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default).decode()
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":"))
+
+
+def join_objects(*objects: bytes) -> bytes:
+    """Merge already-encoded JSON objects into one, without decoding them.
+
+    The members are concatenated in order, so the objects should not share
+    keys.
+    """
+    members = [obj[1:-1] for obj in objects if len(obj) > 2]
+    return b"{" + b",".join(members) + b"}"
+
+
+def encode_fields(fields: Mapping[str, bytes]) -> bytes:
+    """Encode an object whose member values are already-encoded JSON."""
+    members = [dumps(name) + b":" + value for name, value in fields.items()]
+    return b"{" + b",".join(members) + b"}"
+
+
+def loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse that renders through this module.
+
+    As FastAPI's default_response_class it only replaces the final render:
+    FastAPI still runs ``jsonable_encoder`` over whatever an endpoint
+    returns, which costs far more than the encode itself for large results.
+    Hot endpoints therefore return ``FastJSONResponse(content)`` directly,
+    which skips that step; models in ``content`` are encoded by pydantic.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
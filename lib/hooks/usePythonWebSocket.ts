@@ -17,6 +17,7 @@ interface UsePythonWebSocketOptions {
   onStatus?: (status: string) => void;
   onProgress?: (progress: string) => void;
   onQuestion?: (question: string) => void;
+  onDelta?: (agent: string, delta: string) => void;
   onResult?: (agent: string, data: any) => void;
   onComplete?: (summary: string) => void;
   onError?: (error: string) => void;
@@ -32,6 +33,7 @@ interface UsePythonWebSocketReturn {
   currentQuestion: string | null;
   currentStatus: string;
   agentResults: Record<string, any>;
+  agentStreams: Record<string, string>;
   finalSummary: string | null;
 }
 
@@ -42,6 +44,7 @@ export function usePythonWebSocket({
   onStatus,
   onProgress,
   onQuestion,
+  onDelta,
   onResult,
   onComplete,
   onError,
@@ -51,6 +54,7 @@ export function usePythonWebSocket({
   const [currentQuestion, setCurrentQuestion] = useState<string | null>(null);
   const [currentStatus, setCurrentStatus] = useState("");
   const [agentResults, setAgentResults] = useState<Record<string, any>>({});
+  const [agentStreams, setAgentStreams] = useState<Record<string, string>>({});
   const [finalSummary, setFinalSummary] = useState<string | null>(null);
   const [reconnectCount, setReconnectCount] = useState(0);
 
@@ -87,6 +91,16 @@ export function usePythonWebSocket({
             onQuestion?.(message.data.question);
             break;
 
+          case "delta":
+            // Partial agent output; the agent's full result follows
+            setAgentStreams((prev) => ({
+              ...prev,
+              [message.data.agent]:
+                (prev[message.data.agent] ?? "") + message.data.delta,
+            }));
+            onDelta?.(message.data.agent, message.data.delta);
+            break;
+
           case "result":
             if (message.data.agent && message.data.data) {
               setAgentResults((prev) => ({
@@ -120,6 +134,7 @@ export function usePythonWebSocket({
       onStatus,
       onProgress,
       onQuestion,
+      onDelta,
       onResult,
       onComplete,
       onError,
@@ -297,6 +312,7 @@ export function usePythonWebSocket({
     currentQuestion,
     currentStatus,
     agentResults,
+    agentStreams,
     finalSummary,
   };
 }
@@ -0,0 +1,162 @@
+"""
+Event loop lag and slow-callback watchdog.
+
+A monitor thread pings the loop with ``call_soon_threadsafe`` every
+``poll_interval`` seconds. The loop answers the ping as soon as it gets to
+it, so the round trip is the scheduling lag that every ready callback
+sees. When a ping stays unanswered for longer than ``threshold``, a single
+callback or coroutine step is blocking the loop: the thread captures the
+loop thread's stack (``sys._current_frames``) while that step is still
+running, and the stall's duration is filled in once the loop answers.
+
+Recent lag samples and stalls are kept for ``window`` seconds and ``max_stalls``
+entries, and both servers expose them on ``/debug/loop``:
+
+    LOOP_WATCHDOG_THRESHOLD  seconds a step may block before it counts as a stall (default 0.1)
+    LOOP_WATCHDOG_INTERVAL   seconds between pings (default 0.025)
+    LOOP_WATCHDOG_WINDOW     seconds of lag samples kept for the rolling stats (default 60)
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from metrics import record_loop_lag, record_loop_stall
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoopWatchdog:
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        poll_interval: float = 0.025,
+        window: float = 60.0,
+        max_stalls: int = 50,
+        max_frames: int = 30,
+        on_lag: Optional[Callable[[float], None]] = None,
+        on_stall: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ):
+        self.threshold = threshold
+        self.poll_interval = poll_interval
+        self.window = window
+        self.max_frames = max_frames
+        self.on_lag = on_lag
+        self.on_stall = on_stall
+
+        self.samples: Deque[Tuple[float, float]] = deque(maxlen=max(1, int(window / poll_interval)))  # (time, lag)
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=max_stalls)
+        self.stalls_total = 0
+        self.max_lag = 0.0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._ping_sent: Optional[float] = None
+        self._stall: Optional[Dict[str, Any]] = None
+
+    def start(self):
+        """Start watching the running loop; call from inside it."""
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    # --- Monitor thread ---
+    def _monitor(self):
+        while not self._stop.wait(self.poll_interval):
+            with self._lock:
+                sent = self._ping_sent
+                if sent is None:
+                    self._ping_sent = time.perf_counter()
+                    try:
+                        self._loop.call_soon_threadsafe(self._pong, self._ping_sent)
+                    except RuntimeError:  # loop closed
+                        return
+                elif self._stall is None and time.perf_counter() - sent > self.threshold:
+                    self._stall = self._capture()
+
+    def _capture(self) -> Dict[str, Any]:
+        # Runs while the loop thread is still inside the blocking step
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = traceback.format_list(traceback.extract_stack(frame)[-self.max_frames:]) if frame is not None else []
+        return {
+            "detected_at": time.time(),
+            "blocked_ms": None,  # filled in when the loop answers
+            "stack": [line.rstrip() for line in stack],
+        }
+
+    # --- Loop side ---
+    def _pong(self, sent: float):
+        lag = time.perf_counter() - sent
+        with self._lock:
+            self._ping_sent = None
+            stall, self._stall = self._stall, None
+        self.samples.append((time.monotonic(), lag))
+        self.max_lag = max(self.max_lag, lag)
+        if self.on_lag is not None:
+            self.on_lag(lag)
+        if stall is not None:
+            stall["blocked_ms"] = lag * 1000
+            self.stalls.append(stall)
+            self.stalls_total += 1
+            if self.on_stall is not None:
+                self.on_stall(stall)
+
+    def stats(self, stacks: bool = True) -> Dict[str, Any]:
+        cutoff = time.monotonic() - self.window
+        lags = sorted(lag for at, lag in list(self.samples) if at >= cutoff)
+        recent = [stall for stall in list(self.stalls) if stall["detected_at"] >= time.time() - self.window]
+        with self._lock:
+            ongoing = dict(self._stall) if self._stall is not None else None
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "window_s": self.window,
+            "lag_ms": {
+                "samples": len(lags),
+                "p50": percentile(lags, 50) * 1000,
+                "p90": percentile(lags, 90) * 1000,
+                "p99": percentile(lags, 99) * 1000,
+                "max": (lags[-1] if lags else 0.0) * 1000,
+                "max_since_start": self.max_lag * 1000,
+            },
+            "stalls_total": self.stalls_total,
+            "stalls_in_window": len(recent),
+            "ongoing_stall": ongoing if stacks or ongoing is None else {**ongoing, "stack": None},
+            "recent_stalls": [stall if stacks else {**stall, "stack": None} for stall in reversed(recent)],
+        }
+
+
+def create_loop_watchdog(**kwargs) -> LoopWatchdog:
+    """Build a watchdog configured by the LOOP_WATCHDOG_* environment variables."""
+    return LoopWatchdog(
+        threshold=float(os.environ.get("LOOP_WATCHDOG_THRESHOLD", 0.1)),
+        poll_interval=float(os.environ.get("LOOP_WATCHDOG_INTERVAL", 0.025)),
+        window=float(os.environ.get("LOOP_WATCHDOG_WINDOW", 60)),
+        **kwargs
+    )
+
+
+# Feeds the event_loop_* metrics as well as /debug/loop
+loop_watchdog = create_loop_watchdog(on_lag=record_loop_lag, on_stall=record_loop_stall)
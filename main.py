@@ -1,12 +1,27 @@
-import json
+import os
 import time
 import asyncio
-from uuid import uuid4
-from typing import Dict, List, Any, Optional
+from typing import AsyncIterator, Dict, List, Any, Optional, Union
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+import json_codec
+from json_codec import FastJSONResponse
+from loop_watchdog import loop_watchdog
+from conversation_store import create_store, run_sweeper
+from event_log import EventLog, create_event_log, event_logs, get_event_log
+from job_engine import CANCELLED, RUNNING, SUCCEEDED, Job, JobEngine
+from singleflight import SingleFlight
+from thread_router import ThreadRoutingMiddleware, thread_router
+from stage_cache import stage_cache, stage_key
+from workflow_dag import Stage, StageDelta, encode_frozen, freeze, run_stages
+from agent_executor import mock_streaming_agent
+from metrics import (
+    ACTIVE_STREAMS, CONTENT_TYPE, HTTP_REQUEST_SECONDS, HTTP_REQUESTS, STAGE_SECONDS, MetricsMiddleware,
+    register_stage_cache, registry, time_stages, track_active
+)
 
 # --- Data Models ---
 class StartConversationRequest(BaseModel):
@@ -18,13 +33,19 @@ class ContinueClarifierRequest(BaseModel):
     thread_id: str
     answers: List[str]
 
+# Clients may only lower their own priority: 0 (the default) runs first,
+# so nobody can jump ahead of the other users of the shared queue
+MAX_PRIORITY = 9
+
 class RunWorkflowRequest(BaseModel):
     thread_id: str
+    priority: int = Field(0, ge=0, le=MAX_PRIORITY)  # lower runs first
 
 class RunWorkflowStreamRequest(BaseModel):
     text_input: str
     image_input: Optional[str] = None
     audio_input: Optional[str] = None
+    priority: int = Field(0, ge=0, le=MAX_PRIORITY)
 
 class ClarifierQuestion(BaseModel):
     question: str
@@ -41,7 +62,11 @@ class ConversationState(BaseModel):
     workflow_result: Optional[Dict[str, Any]] = None
 
 # --- FastAPI App ---
-app = FastAPI(title="Product Conversation API", version="1.0.0")
+app = FastAPI(
+    title="Product Conversation API",
+    version="1.0.0",
+    default_response_class=FastJSONResponse
+)
 
 # Add CORS middleware
 app.add_middleware(
@@ -52,8 +77,91 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- In-memory storage for conversations ---
-conversations: Dict[str, ConversationState] = {}
+# Per-route latency and status counts, served on /metrics
+app.add_middleware(MetricsMiddleware, latency=HTTP_REQUEST_SECONDS, requests=HTTP_REQUESTS)
+
+# With several workers, a thread's requests go to the worker holding its
+# state (see thread_router.py). Added last so it runs first: forwarded
+# requests are timed once, by the owner.
+THREAD_ROUTES = registry.counter(
+    "thread_routing_requests_total",
+    "Thread requests served by the owning worker, forwarded to it, or served here because it was gone",
+    ("outcome",)
+)
+app.add_middleware(
+    ThreadRoutingMiddleware,
+    router=thread_router,
+    routed=THREAD_ROUTES,
+    path_prefixes=("/get_result/", "/get_state/", "/cancel_workflow/", "/run_workflow_stream/"),
+    body_paths=("/continue_clarifier", "/run_workflow")
+)
+
+# --- Conversation storage (in-memory or SQLite, see conversation_store.py) ---
+# Each thread has one owning worker when routing is on, so a shared store can
+# sit behind a local cache and hot state is not re-read on every call
+conversations = create_store(
+    encode=lambda conv: conv.model_dump_json(),
+    decode=ConversationState.model_validate_json,
+    local_cache=thread_router.enabled
+)
+
+sweeper_tasks: List[asyncio.Task] = []
+
+# Concurrent /run_workflow_stream requests with the same normalized input share
+# one run of the stages (see singleflight.py)
+workflow_flights = SingleFlight()
+
+# --- Workflow jobs (one per thread, see job_engine.py) ---
+# At most WORKFLOW_WORKERS pipelines run at once; the rest wait in priority order
+workflow_jobs = JobEngine(
+    max_workers=int(os.environ.get("WORKFLOW_WORKERS", 4)),
+    default_timeout=float(os.environ.get("WORKFLOW_TIMEOUT", 300))
+)
+
+# --- Metrics (see metrics.py); read from the stores and engine at scrape time ---
+def workflow_job_counts() -> Dict[tuple, int]:
+    stats = workflow_jobs.stats()
+    return {("queued",): stats["queued"], ("running",): stats["running"]}
+
+registry.gauge_callback("workflow_jobs", "Workflow jobs by state", workflow_job_counts, ("state",))
+registry.gauge_callback("conversations", "Conversations held in the store", lambda: len(conversations))
+registry.gauge_callback("workflow_flights_in_flight", "Distinct workflow runs in flight", lambda: len(workflow_flights.flights))
+register_stage_cache(stage_cache)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    sweeper_tasks.append(asyncio.create_task(run_sweeper(conversations)))
+    sweeper_tasks.append(asyncio.create_task(run_sweeper(event_logs)))
+    sweeper_tasks.append(asyncio.create_task(run_sweeper(workflow_jobs.jobs)))
+    sweeper_tasks.append(asyncio.create_task(run_sweeper(stage_cache)))
+    loop_watchdog.start()
+    await workflow_jobs.start()
+    await thread_router.start(app)
+
+@app.on_event("shutdown")
+async def close_conversation_store():
+    await thread_router.close()
+    await workflow_jobs.stop()
+    loop_watchdog.stop()
+    for task in sweeper_tasks:
+        task.cancel()
+    conversations.close()
+    stage_cache.close()
+
+# Upper bound for /get_result?wait=, in seconds
+MAX_RESULT_WAIT = float(os.environ.get("MAX_RESULT_WAIT", 30))
+
+def submit_workflow_job(thread_id: str, fn, priority: int) -> Job:
+    try:
+        return workflow_jobs.submit(thread_id, fn, priority=priority)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+def get_conversation(thread_id: str) -> ConversationState:
+    conv = conversations.get(thread_id)
+    if conv is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conv
 
 # --- Helper Functions ---
 def generate_mock_product_result():
@@ -109,12 +217,88 @@ def generate_mock_risk_result():
 def generate_mock_summary():
     return "A comprehensive fitness tracking application that helps users monitor workouts, track nutrition, and share progress with their community. The app will feature personalized recommendations, social challenges, and detailed analytics to keep users motivated."
 
+# --- Workflow Stages ---
+# customer/engineer/risk only need the clarifier and product output, so they
+# run concurrently once the product stage has finished.
+async def run_product_stage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+    return generate_mock_product_result()
+
+async def run_customer_stage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+    return generate_mock_customer_result()
+
+async def run_engineer_stage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+    return generate_mock_engineer_result()
+
+async def run_risk_stage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+    return generate_mock_risk_result()
+
+# Seconds between the summary's streamed chunks (the mock streams it like an LLM)
+MOCK_TOKEN_DELAY = float(os.environ.get("MOCK_TOKEN_DELAY", 0))
+
+async def run_summary_stage(inputs: Dict[str, Any]) -> AsyncIterator[Union[str, Dict[str, Any]]]:
+    summary = generate_mock_summary()
+    async for chunk in mock_streaming_agent(summary, MOCK_TOKEN_DELAY, words_per_chunk=4):
+        yield chunk
+    yield {"summary": summary}
+
+async def run_tts_stage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+    return {"tts_file": "https://example.com/speech.mp3"}
+
+# Each stage's runs are timed in the agent_stage_duration_seconds histogram
+WORKFLOW_STAGES = time_stages([
+    Stage("product", run_product_stage, ("clarifier",)),
+    Stage("customer", run_customer_stage, ("clarifier", "product")),
+    Stage("engineer", run_engineer_stage, ("clarifier", "product")),
+    Stage("risk", run_risk_stage, ("clarifier", "product")),
+    Stage("summary", run_summary_stage, ("product", "customer", "engineer", "risk")),
+    Stage("tts", run_tts_stage, ("summary",)),
+], STAGE_SECONDS)
+
+def workflow_stages(clarifier: ClarifierResponse) -> List[Stage]:
+    """The workflow stages, memoized on the user's input and clarifier answers."""
+    answers = [q.answer for q in clarifier.resp]
+    return stage_cache.wrap(WORKFLOW_STAGES, answers[0] if answers else None, answers)
+
+# Stages whose outputs are flattened into the workflow result, in order
+MERGED_STAGES = ("product", "customer", "engineer", "risk", "summary", "tts")
+
+def merge_workflow_result(clarifier: Dict[str, Any], results: Dict[str, Any]) -> Dict[str, Any]:
+    """Merge the per-stage outputs into the flat workflow result."""
+    merged = {"clarifier": clarifier}
+    for stage in MERGED_STAGES:
+        merged.update(results[stage])
+    return merged
+
+def encode_workflow_result(clarifier: bytes, results: Dict[str, Any], merged: Dict[str, Any]) -> bytes:
+    """Assemble the merged result's JSON from the stages' cached encodings.
+    
+    This costs a copy of the bytes rather than a re-encode of the whole
+    result, which pays off once agent outputs are more than a few KB.
+    """
+    members = [clarifier]
+    keys = 1
+    for stage in MERGED_STAGES:
+        keys += len(results[stage])
+        members.append(encode_frozen(results[stage])[1:-1])
+    if keys != len(merged):
+        # Stages share a key; only a real merge resolves it
+        return json_codec.dumps(merged)
+    return b'{"clarifier":' + b",".join(member for member in members if member) + b"}"
+
+def encode_stage_event(step: str, data: bytes, thread_id: str) -> bytes:
+    """Encode a stream step around its already-encoded data."""
+    return json_codec.join_objects(
+        json_codec.dumps({"step": step, "status": "success"}),
+        json_codec.encode_fields({"data": data}),
+        json_codec.dumps({"thread_id": thread_id, "timestamp": time.time()})
+    )
+
 # --- API Endpoints ---
 
 @app.post("/start_conversation")
 async def start_conversation(request: StartConversationRequest):
     """Start a new clarifier conversation with initial input."""
-    thread_id = str(uuid4())
+    thread_id = thread_router.new_thread_id()
     
     # Initialize conversation state with clarifier questions
     clarifier_questions = [
@@ -134,20 +318,17 @@ async def start_conversation(request: StartConversationRequest):
     for question in clarifier_questions[1:]:
         clarifier_resp.append(ClarifierQuestion(question=question))
     
-    conversations[thread_id] = ConversationState(
+    conversations.put(thread_id, ConversationState(
         clarifier=ClarifierResponse(resp=clarifier_resp, done=False),
         current_round=1
-    )
+    ))
     
-    return {"type": "start", "thread_id": thread_id}
+    return FastJSONResponse({"type": "start", "thread_id": thread_id})
 
 @app.post("/continue_clarifier")
 async def continue_clarifier(request: ContinueClarifierRequest):
     """Continue the clarifier conversation by providing answers to previous questions."""
-    if request.thread_id not in conversations:
-        raise HTTPException(status_code=404, detail="Conversation not found")
-    
-    conv = conversations[request.thread_id]
+    conv = get_conversation(request.thread_id)
     
     # Update answers
     questions = conv.clarifier.resp
@@ -162,81 +343,112 @@ async def continue_clarifier(request: ContinueClarifierRequest):
     all_answered = all(q.answer is not None for q in questions)
     conv.clarifier.done = all_answered
     conv.current_round += 1
+    conversations.put(request.thread_id, conv)
     
-    return {
+    return FastJSONResponse({
         "type": "continue",
         "thread_id": request.thread_id,
-        "content": conv.clarifier.json()
-    }
+        "content": conv.clarifier.model_dump_json()
+    })
 
 @app.get("/get_state/{thread_id}")
 async def get_state(thread_id: str):
     """Retrieve the current state of a conversation."""
-    if thread_id not in conversations:
-        raise HTTPException(status_code=404, detail="Conversation not found")
-    
-    conv = conversations[thread_id]
-    return {
+    conv = get_conversation(thread_id)
+    # The model is encoded by pydantic's serializer, without a dict in between
+    return FastJSONResponse({
         "thread_id": thread_id,
-        "state": conv.dict(),
+        "state": conv,
         "clarifier_done": conv.clarifier.done,
         "current_round": conv.current_round
-    }
+    })
 
 @app.post("/run_workflow")
 async def run_workflow(request: RunWorkflowRequest):
     """Start the product analysis workflow in the background."""
-    if request.thread_id not in conversations:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    conv = get_conversation(request.thread_id)
     
-    if not conversations[request.thread_id].clarifier.done:
+    if not conv.clarifier.done:
         raise HTTPException(status_code=400, detail="Clarifier not completed")
     
-    # Mark workflow as started
-    conversations[request.thread_id].workflow_started = True
+    # Queue the workflow on the job engine
+    job = submit_workflow_job(
+        request.thread_id,
+        lambda: process_workflow_async(request.thread_id),
+        request.priority
+    )
     
-    # Simulate async workflow processing
-    asyncio.create_task(process_workflow_async(request.thread_id))
+    # Mark workflow as started
+    conv.workflow_started = True
+    conversations.put(request.thread_id, conv)
     
-    return {"status": "workflow_started", "thread_id": request.thread_id}
+    return FastJSONResponse({"status": "workflow_started", "thread_id": request.thread_id, "job": job.status})
 
-async def process_workflow_async(thread_id: str):
-    """Simulate workflow processing in the background."""
-    # Simulate processing time
-    await asyncio.sleep(2)
-    
-    if thread_id in conversations:
-        # Generate mock results
-        conversations[thread_id].workflow_result = {
-            "clarifier": conversations[thread_id].clarifier.dict(),
-            **generate_mock_product_result(),
-            **generate_mock_customer_result(),
-            **generate_mock_engineer_result(),
-            **generate_mock_risk_result(),
-            "summary": generate_mock_summary(),
-            "tts_file": "https://example.com/speech.mp3"
-        }
+async def process_workflow_async(thread_id: str) -> Optional[Dict[str, Any]]:
+    """Run the workflow stages as a background job and store the merged result."""
+    conv = conversations.get(thread_id)
+    if conv is None:
+        return None
+
+    clarifier = conv.clarifier.dict()
+    results = {}
+    async for stage_result in run_stages(workflow_stages(conv.clarifier), {"clarifier": clarifier}):
+        results[stage_result.stage] = stage_result.data
+
+    final_result = merge_workflow_result(clarifier, results)
+    conv = conversations.get(thread_id)
+    if conv is not None:
+        conv.workflow_result = final_result
+        conversations.put(thread_id, conv)
+    return final_result
 
 @app.get("/get_result/{thread_id}")
-async def get_result(thread_id: str):
-    """Retrieve the final result of the workflow after it completes."""
-    if thread_id not in conversations:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+async def get_result(thread_id: str, wait: float = 0):
+    """Retrieve the final result of the workflow after it completes.
     
-    conv = conversations[thread_id]
+    With `wait` (seconds), a pending request is held until the workflow
+    finishes or the wait runs out instead of returning 202 right away.
+    """
+    conv = get_conversation(thread_id)
     
     if not conv.workflow_started:
         raise HTTPException(status_code=400, detail="Workflow not started")
     
+    # Prefer the job's own output; fall back to the stored result once the
+    # job has aged out of the engine
+    job = workflow_jobs.get(thread_id)
+    if job is not None:
+        if not job.done and wait > 0:
+            await job.wait(min(wait, MAX_RESULT_WAIT))
+        if not job.done:
+            raise HTTPException(status_code=202, detail=f"Workflow {job.status}")
+        if job.status == CANCELLED:
+            raise HTTPException(status_code=409, detail="Workflow cancelled")
+        if job.status != SUCCEEDED:
+            raise HTTPException(status_code=500, detail=job.error or f"Workflow {job.status}")
+        return FastJSONResponse(job.result)
+    
     if not conv.workflow_result:
         raise HTTPException(status_code=202, detail="Workflow still processing")
     
-    return conv.workflow_result
+    return FastJSONResponse(conv.workflow_result)
+
+@app.post("/cancel_workflow/{thread_id}")
+async def cancel_workflow(thread_id: str):
+    """Cancel a queued or running workflow job."""
+    job = workflow_jobs.get(thread_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Workflow job not found")
+    
+    if not job.cancel():
+        raise HTTPException(status_code=409, detail=f"Workflow already {job.status}")
+    
+    return FastJSONResponse({"status": "cancelling" if job.status == RUNNING else job.status, "thread_id": thread_id})
 
 @app.post("/run_workflow_stream")
 async def run_workflow_stream(request: RunWorkflowStreamRequest):
     """Run the entire workflow in one go and stream the results in real-time."""
-    thread_id = str(uuid4())
+    thread_id = thread_router.new_thread_id()
     
     # Initialize conversation with first answer
     clarifier_questions = [
@@ -261,107 +473,115 @@ async def run_workflow_stream(request: RunWorkflowStreamRequest):
     clarifier = ClarifierResponse(resp=clarifier_resp, done=True)
     
     # Store conversation
-    conversations[thread_id] = ConversationState(
+    conv = ConversationState(
         clarifier=clarifier,
         current_round=1,
         workflow_started=True
     )
+    conversations.put(thread_id, conv)
     
-    async def generate_stream():
-        timestamp = time.time()
-        
+    # The pipeline runs as a job and records every step in the thread's
+    # event log; the response just tails that log, so a slow or dropped
+    # reader never holds up the pipeline
+    log = create_event_log(thread_id)
+    job = submit_workflow_job(thread_id, lambda: stream_workflow(thread_id, conv, log), request.priority)
+    job.add_done_callback(lambda job: close_event_log(job, log))
+    
+    return StreamingResponse(
+        track_active(log.tail(), ACTIVE_STREAMS),
+        media_type="application/x-ndjson"
+    )
+
+@app.get("/run_workflow_stream/{thread_id}")
+async def resume_workflow_stream(thread_id: str, request: Request, after_seq: Optional[int] = None):
+    """Replay the stream events after `after_seq` (or the Last-Event-ID header), then follow live ones."""
+    log = get_event_log(thread_id)
+    if log is None:
+        raise HTTPException(status_code=404, detail="Workflow stream not found")
+    
+    if after_seq is None:
+        last_event_id = request.headers.get("last-event-id", "0")
+        after_seq = int(last_event_id) if last_event_id.isdigit() else 0
+    
+    return StreamingResponse(
+        track_active(log.tail(after_seq), ACTIVE_STREAMS),
+        media_type="application/x-ndjson"
+    )
+
+def close_event_log(job: Job, log: EventLog):
+    """Close the stream once its job is over, logging why if the job never got to."""
+    if log.closed:
+        return
+    if job.status != SUCCEEDED:
+        log.append({
+            "step": "error",
+            "status": job.status,
+            "error": job.error or f"Workflow {job.status}",
+            "thread_id": log.thread_id,
+            "timestamp": time.time()
+        })
+    log.close()
+
+async def stream_workflow(thread_id: str, conv: ConversationState, log: EventLog) -> Dict[str, Any]:
+    """Run the workflow stages and append each step to the thread's event log."""
+    try:
         # Start
-        yield json.dumps({
+        log.append({
             "step": "start",
             "status": "success",
             "data": {"thread_id": thread_id},
             "thread_id": thread_id,
-            "timestamp": timestamp
-        }) + "\n"
+            "timestamp": time.time()
+        })
         
         # Clarifier
-        yield json.dumps({
-            "step": "clarifier",
-            "status": "success",
-            "data": clarifier.dict(),
-            "thread_id": thread_id,
-            "timestamp": timestamp + 1
-        }) + "\n"
+        clarifier_data = freeze(conv.clarifier.model_dump())
+        log.append(encode_stage_event("clarifier", clarifier_data.encoded, thread_id))
         
-        # Product
-        yield json.dumps({
-            "step": "product",
-            "status": "success",
-            "data": generate_mock_product_result(),
-            "thread_id": thread_id,
-            "timestamp": timestamp + 2
-        }) + "\n"
-        
-        # Customer
-        yield json.dumps({
-            "step": "customer",
-            "status": "success",
-            "data": generate_mock_customer_result(),
-            "thread_id": thread_id,
-            "timestamp": timestamp + 3
-        }) + "\n"
-        
-        # Engineer
-        yield json.dumps({
-            "step": "engineer",
-            "status": "success",
-            "data": generate_mock_engineer_result(),
-            "thread_id": thread_id,
-            "timestamp": timestamp + 4
-        }) + "\n"
-        
-        # Risk
-        yield json.dumps({
-            "step": "risk",
-            "status": "success",
-            "data": generate_mock_risk_result(),
-            "thread_id": thread_id,
-            "timestamp": timestamp + 5
-        }) + "\n"
-        
-        # Summary
-        yield json.dumps({
-            "step": "summary",
-            "status": "success",
-            "data": {"summary": generate_mock_summary()},
-            "thread_id": thread_id,
-            "timestamp": timestamp + 6
-        }) + "\n"
-        
-        # TTS
-        yield json.dumps({
-            "step": "tts",
-            "status": "success",
-            "data": {"tts_file": "https://example.com/speech.mp3"},
-            "thread_id": thread_id,
-            "timestamp": timestamp + 7
-        }) + "\n"
+        # Product, customer, engineer, risk, summary and TTS, each logged
+        # as soon as its stage finishes. Each output is encoded once, here,
+        # and reused for the final result. A duplicate of a request that is
+        # already running follows that run instead of starting its own.
+        answers = [q.answer for q in conv.clarifier.resp]
+        stage_results = workflow_flights.stream(
+            stage_key("workflow", None, answers, {}),
+            lambda: run_stages(workflow_stages(conv.clarifier), {"clarifier": clarifier_data}, deltas=True)
+        )
+        results = {}
+        async for stage_result in stage_results:
+            if isinstance(stage_result, StageDelta):
+                # Partial text of a streaming stage; its full result still follows
+                log.append({
+                    "step": "delta",
+                    "stage": stage_result.stage,
+                    "delta": stage_result.text,
+                    "thread_id": thread_id,
+                    "timestamp": time.time()
+                })
+                continue
+            results[stage_result.stage] = stage_result.data
+            log.append(encode_stage_event(stage_result.stage, encode_frozen(stage_result.data), thread_id))
         
         # Final result
-        final_result = {
-            "clarifier": clarifier.dict(),
-            **generate_mock_product_result(),
-            **generate_mock_customer_result(),
-            **generate_mock_engineer_result(),
-            **generate_mock_risk_result(),
-            "summary": generate_mock_summary(),
-            "tts_file": "https://example.com/speech.mp3"
-        }
+        final_result = merge_workflow_result(clarifier_data, results)
         
         # Store the result
-        conversations[thread_id].workflow_result = final_result
+        conv.workflow_result = final_result
+        conversations.put(thread_id, conv)
         
-        yield json.dumps(final_result) + "\n"
-    
-    return StreamingResponse(
-        generate_stream(),
-        media_type="application/x-ndjson"
-    )
+        log.append(encode_workflow_result(clarifier_data.encoded, results, final_result))
+        log.close()
+        return final_result
+    except Exception as e:
+        log.append({
+            "step": "error",
+            "status": "error",
+            "error": str(e),
+            "thread_id": thread_id,
+            "timestamp": time.time()
+        })
+        log.close()
+        raise
 
 # --- Health Check ---
 @app.get("/health")
@@ -369,9 +589,31 @@ async def health_check():
     return {
         "status": "ok",
         "timestamp": time.time(),
-        "conversations": len(conversations)
+        "conversations": len(conversations),
+        "store": conversations.stats(),
+        "jobs": workflow_jobs.stats(),
+        "stage_cache": stage_cache.stats(),
+        "flights": workflow_flights.stats(),
+        "shard": thread_router.stats()
     }
 
+# --- Prometheus metrics ---
+@app.get("/metrics")
+async def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+# --- Event loop watchdog (see loop_watchdog.py) ---
+@app.get("/debug/loop")
+async def debug_loop(stacks: bool = True):
+    return loop_watchdog.stats(stacks)
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    host, port = os.environ.get("HOST", "0.0.0.0"), int(os.environ.get("PORT", 8000))
+    workers = int(os.environ.get("WORKERS", 1))
+    if workers > 1:
+        # Workers import the app themselves and inherit THREAD_ROUTING
+        os.environ["THREAD_ROUTING"] = "1"
+        uvicorn.run("main:app", host=host, port=port, workers=workers)
+    else:
+        uvicorn.run(app, host=host, port=port)
\ No newline at end of file
@@ -0,0 +1,367 @@
+"""
+Prometheus-style metrics, exposed in the text exposition format.
+
+Metrics are recorded from the event loop thread, so no locks are needed: a
+counter increment is an attribute add, and a histogram observation is a
+bisect over the bucket bounds plus a list increment. Work from other threads
+(agent executors) is already handed back to the loop before it is recorded.
+Label lookups cost a dict access, so hot paths bind their labelled child
+once (``MESSAGES.labels("out")``) and keep it.
+
+Values that already exist elsewhere, such as queue depths, connection counts
+and cache stats, are exposed as gauges or counters backed by a callback. The callback
+runs only when /metrics is scraped, so it costs the hot path nothing.
+"""
+
+import inspect
+import math
+import time
+from bisect import bisect_left
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Sequence, Tuple, Union
+
+from workflow_dag import Stage
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; agent stages run from milliseconds (cache-cold mocks) to minutes (LLM calls)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class GaugeValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def track(self) -> "InProgress":
+        """Context manager that counts the code inside it as in progress."""
+        return InProgress(self)
+
+
+class InProgress:
+    __slots__ = ("gauge",)
+
+    def __init__(self, gauge: GaugeValue):
+        self.gauge = gauge
+
+    def __enter__(self):
+        self.gauge.inc()
+        return self
+
+    def __exit__(self, *exc):
+        self.gauge.dec()
+
+
+class HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "Timer":
+        """Context manager that observes the time spent inside it."""
+        return Timer(self)
+
+
+class Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: HistogramValue):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """A metric family: one value per combination of label values."""
+
+    def __init__(self, kind: str, name: str, help: str, labelnames: Sequence[str], new_value: Callable[[], Any]):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._new_value = new_value
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: str):
+        value = self._values.get(values)
+        if value is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            value = self._values[values] = self._new_value()
+        return value
+
+    def collect(self) -> Iterator[Tuple[Tuple[str, ...], Any]]:
+        return iter(list(self._values.items()))
+
+
+class CallbackMetric:
+    """A gauge or counter read from ``fn`` at scrape time.
+
+    ``fn`` returns a number, or for labelled metrics a mapping of label-value
+    tuples to numbers.
+    """
+
+    def __init__(self, kind: str, name: str, help: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def collect(self) -> Iterator[Tuple[Tuple[str, ...], Any]]:
+        values = self.fn()
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in values.items():
+            yield labels, value
+
+
+def format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Union[Metric, CallbackMetric]] = {}
+
+    def _register(self, metric):
+        # Registering a name again returns the existing metric, so a module
+        # that is imported twice keeps recording into the same values
+        existing = self.metrics.get(metric.name)
+        if existing is not None and not isinstance(metric, CallbackMetric):
+            if existing.kind != metric.kind or existing.labelnames != metric.labelnames:
+                raise ValueError(f"Metric {metric.name} already registered with a different type or labels")
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        """Register a counter; without labels the value itself is returned."""
+        metric = self._register(Metric("counter", name, help, labelnames, CounterValue))
+        return metric if labelnames else metric.labels()
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        metric = self._register(Metric("gauge", name, help, labelnames, GaugeValue))
+        return metric if labelnames else metric.labels()
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        bounds = tuple(sorted(buckets))
+        metric = self._register(Metric("histogram", name, help, labelnames, lambda: HistogramValue(bounds)))
+        return metric if labelnames else metric.labels()
+
+    def gauge_callback(self, name: str, help: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self._register(CallbackMetric("gauge", name, help, fn, labelnames))
+
+    def counter_callback(self, name: str, help: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()) -> CallbackMetric:
+        """A counter kept elsewhere (e.g. in a stats dict), read at scrape time."""
+        return self._register(CallbackMetric("counter", name, help, fn, labelnames))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, value in metric.collect():
+                if metric.kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(value.bounds + (math.inf,), value.counts):
+                        cumulative += count
+                        le = 'le="' + format_value(bound) + '"'
+                        lines.append(f"{metric.name}_bucket{format_labels(metric.labelnames, labels, le)} {cumulative}")
+                    suffix = format_labels(metric.labelnames, labels)
+                    lines.append(f"{metric.name}_sum{suffix} {format_value(value.sum)}")
+                    lines.append(f"{metric.name}_count{suffix} {value.count}")
+                else:
+                    number = value.value if isinstance(value, (CounterValue, GaugeValue)) else value
+                    lines.append(f"{metric.name}{format_labels(metric.labelnames, labels)} {format_value(number)}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+# --- Helpers ---
+def time_stages(stages: Sequence[Stage], histogram: Metric) -> List[Stage]:
+    """Return ``stages`` with each run observed in ``histogram`` under its stage name.
+
+    Apply before ``StageCache.wrap`` so the histogram measures real agent
+    runs; cache hits show up in the cache's own counters instead.
+    """
+    return [Stage(stage.name, _timed(stage.fn, histogram.labels(stage.name)), stage.deps) for stage in stages]
+
+
+def _timed(fn, histogram: HistogramValue):
+    async def run(inputs: Dict[str, Any]) -> Any:
+        with histogram.time():
+            return await fn(inputs)
+
+    async def stream(inputs: Dict[str, Any]) -> AsyncIterator[Any]:
+        with histogram.time():
+            async for item in fn(inputs):
+                yield item
+
+    return stream if inspect.isasyncgenfunction(fn) else run
+
+
+async def track_active(stream: AsyncIterator[Any], gauge: GaugeValue) -> AsyncIterator[Any]:
+    """Iterate ``stream`` while counting it in ``gauge``."""
+    with gauge.track():
+        async for item in stream:
+            yield item
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the latency and status of every HTTP request.
+
+    Requests are labelled with their route template (``/get_result/{thread_id}``),
+    so per-thread paths do not explode the label set. Streaming responses are
+    timed until their last chunk is sent.
+    """
+
+    def __init__(self, app, latency: Metric, requests: Metric):
+        self.app = app
+        self.latency = latency
+        self.requests = requests
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            self.latency.labels(scope["method"], path).observe(time.perf_counter() - start)
+            self.requests.labels(scope["method"], path, str(status[0])).inc()
+
+
+# --- Default registry and the metrics both servers share ---
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "agent_stage_duration_seconds",
+    "Time an agent stage took to produce its result",
+    ("stage",)
+)
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route, until the last body chunk is sent",
+    ("method", "route")
+)
+HTTP_REQUESTS = registry.counter(
+    "http_requests_total",
+    "HTTP requests by route and status code",
+    ("method", "route", "status")
+)
+ACTIVE_STREAMS = registry.gauge("active_streams", "Workflow streams or conversations currently running")
+LOOP_LAG = registry.gauge("event_loop_lag_seconds", "Most recent event loop scheduling lag")
+LOOP_LAG_SECONDS = registry.histogram(
+    "event_loop_lag_distribution_seconds",
+    "Event loop scheduling lag",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+
+
+LOOP_STALLS = registry.counter(
+    "event_loop_stalls_total",
+    "Callbacks or coroutine steps that blocked the loop past the watchdog threshold"
+)
+
+
+def record_loop_lag(lag: float) -> None:
+    """Lag sample from the loop watchdog (see loop_watchdog.py)."""
+    LOOP_LAG.set(lag)
+    LOOP_LAG_SECONDS.observe(lag)
+
+
+def record_loop_stall(stall: Dict[str, Any]) -> None:
+    LOOP_STALLS.inc()
+
+
+def register_agent_pools(executor) -> None:
+    """Expose each agent pool's waiting and running calls (see agent_executor.py)."""
+    registry.gauge_callback(
+        "agent_pool_waiting",
+        "Agent calls waiting for a slot in their pool",
+        lambda: {(name,): pool.waiting for name, pool in executor.pools.items()},
+        ("agent",)
+    )
+    registry.gauge_callback(
+        "agent_pool_running",
+        "Agent calls running in their pool",
+        lambda: {(name,): pool.running for name, pool in executor.pools.items()},
+        ("agent",)
+    )
+
+
+def register_stage_cache(cache) -> None:
+    # cache.hits counts disk hits too; the outcomes are disjoint so they sum to the lookups
+    registry.counter_callback(
+        "stage_cache_lookups_total",
+        "Stage cache lookups by outcome",
+        lambda: {
+            ("memory_hit",): cache.hits - cache.disk_hits,
+            ("disk_hit",): cache.disk_hits,
+            ("miss",): cache.misses
+        },
+        ("outcome",)
+    )
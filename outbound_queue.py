@@ -0,0 +1,171 @@
+"""
+Bounded per-connection send queue drained by a dedicated writer task.
+
+Producers (the agent pipeline, broadcasts) enqueue already-encoded frames and
+return immediately; only the writer task waits on the client's network. When
+the queue is full the overflow policy decides what happens:
+
+    block        wait until the writer makes room
+    drop_oldest  drop the oldest droppable (status/progress) frame; if none is
+                 queued, drop the new frame when it is droppable, otherwise
+                 disconnect
+    disconnect   close the connection
+
+With batching enabled (``configure_batching``), the writer waits up to
+``batch_window`` seconds for more frames and sends up to ``batch_size`` of
+them as one JSON array frame, saving a write and frame header per message.
+
+Producers that can slow down should await ``wait_drained`` between frames:
+it returns immediately unless the client has fallen behind (more than
+``high_water`` frames queued) and then waits until the writer has brought the
+queue back down to ``low_water``.
+"""
+
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "disconnect")
+
+# Message types that only report progress and can be dropped under pressure
+DROPPABLE_TYPES = frozenset({"status", "progress"})
+
+
+class OutboundQueue:
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        on_error: Callable[[str], None],
+        maxsize: int = 256,
+        policy: str = "drop_oldest",
+        send_timeout: Optional[float] = None,
+    ):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.send = send
+        self.on_error = on_error
+        self.maxsize = maxsize
+        self.policy = policy
+        self.send_timeout = send_timeout
+
+        self._frames: Deque[Tuple[str, str]] = deque()  # (payload, message type)
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self.high_water = max(1, maxsize // 2)
+        self.low_water = maxsize // 4
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self.batch_size = 1  # 1 means batching is off
+        self.batch_window = 0.0
+        self.closed = False
+        self._timed_out = False
+        self.sent = 0
+        self.dropped = 0
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def stats(self) -> Dict[str, int]:
+        return {"depth": len(self._frames), "sent": self.sent, "dropped": self.dropped}
+
+    async def put(self, payload: str, message_type: str = "") -> bool:
+        """Queue a frame, waiting for room under the block policy.
+
+        Returns False if the frame was not queued.
+        """
+        while self.policy == "block" and not self.closed and len(self._frames) >= self.maxsize:
+            self._not_full.clear()
+            await self._not_full.wait()
+        return self.put_nowait(payload, message_type)
+
+    def put_nowait(self, payload: str, message_type: str = "") -> bool:
+        """Queue a frame without waiting; a full queue is handled by the overflow policy."""
+        if self.closed:
+            return False
+        if len(self._frames) >= self.maxsize:
+            if self.policy == "drop_oldest" and self._drop_oldest():
+                pass
+            elif self.policy == "drop_oldest" and message_type in DROPPABLE_TYPES:
+                self.dropped += 1
+                return False
+            else:
+                self.on_error("Send queue overflow")
+                return False
+
+        self._frames.append((payload, message_type))
+        self._not_empty.set()
+        return True
+
+    def configure_batching(self, batch_size: int, batch_window: float):
+        """Coalesce frames into JSON arrays; ``batch_size`` 1 turns batching off."""
+        self.batch_size = max(1, batch_size)
+        self.batch_window = max(0.0, batch_window)
+
+    async def wait_drained(self):
+        """Apply backpressure only while the client is behind."""
+        if self.closed or len(self._frames) <= self.high_water:
+            return
+        self._drained.clear()
+        await self._drained.wait()
+
+    def _drop_oldest(self) -> bool:
+        for index, (_, message_type) in enumerate(self._frames):
+            if message_type in DROPPABLE_TYPES:
+                del self._frames[index]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _write_loop(self):
+        while not self.closed:
+            if not self._frames:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+                continue
+
+            if self.batch_size > 1:
+                if len(self._frames) < self.batch_size and self.batch_window:
+                    await asyncio.sleep(self.batch_window)
+                    if not self._frames:
+                        continue
+                count = min(self.batch_size, len(self._frames))
+                payload = "[" + ",".join(self._frames.popleft()[0] for _ in range(count)) + "]"
+            else:
+                payload, _ = self._frames.popleft()
+            self._not_full.set()
+            if len(self._frames) <= self.low_water:
+                self._drained.set()
+            # A timer handle is much cheaper per send than wrapping it in wait_for
+            timer = None
+            if self.send_timeout is not None:
+                timer = asyncio.get_running_loop().call_later(self.send_timeout, self._send_timed_out)
+            try:
+                await self.send(payload)
+                self.sent += 1
+            except asyncio.CancelledError:
+                if self._timed_out:
+                    self.on_error("Slow consumer")
+                    return
+                raise
+            except Exception as e:
+                self.on_error(f"Send failed: {e}")
+                return
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    def _send_timed_out(self):
+        self._timed_out = True
+        self._writer.cancel()
+
+    def close(self):
+        """Stop the writer; queued frames are discarded."""
+        self.closed = True
+        self._frames.clear()
+        self._not_full.set()
+        self._not_empty.set()
+        self._drained.set()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
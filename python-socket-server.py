@@ -1,15 +1,35 @@
+import os
 import json
 import asyncio
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, WebSocketState
-from typing import List, Optional
+import math
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.websockets import WebSocketState
+from typing import Dict, List, Optional, Set, Tuple
 from langchain_core.messages import HumanMessage
 import uvicorn
 import logging
+from collections import OrderedDict
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Structured, queued logging; per-message events are sampled (see structured_log.py)
+from structured_log import bind, get_logger, setup_logging
+log_handler = setup_logging()
+logger = get_logger("socket_server")
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
+
+import json_codec
+from json_codec import FastJSONResponse
+from loop_watchdog import loop_watchdog
+from outbound_queue import OutboundQueue
+from room_pubsub import BROADCAST_ROOM, RoomPubSub, InProcessPubSub, create_room_pubsub
+from workflow_dag import Stage, StageDelta, run_stages
+from conversation_store import run_sweeper
+from stage_cache import stage_cache
+from agent_executor import AgentTimeout, agent_executor, mock_agent, mock_streaming_agent
+from metrics import (
+    ACTIVE_STREAMS, CONTENT_TYPE, HTTP_REQUEST_SECONDS, HTTP_REQUESTS, STAGE_SECONDS, MetricsMiddleware,
+    register_agent_pools, register_stage_cache, registry, time_stages
+)
 
 # Import your agent modules here
 # from agent import clarifier, product
@@ -23,7 +43,11 @@ from fastapi.middleware.cors import CORSMiddleware
 # --- Configuration ---
 config = {"configurable": {"thread_id": "product_conversation"}}
 
-app = FastAPI()
+# "flow" only slows the pipeline down when a client's send queue backs up;
+# "fixed" restores the old fixed delays between messages for demos
+PACING_MODE = os.environ.get("PACING_MODE", "flow")
+
+app = FastAPI(default_response_class=FastJSONResponse)
 
 # Add CORS middleware to match your JavaScript client
 app.add_middleware(
@@ -35,15 +59,63 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
+# Per-route latency and status counts, served on /metrics
+app.add_middleware(MetricsMiddleware, latency=HTTP_REQUEST_SECONDS, requests=HTTP_REQUESTS)
+
+# --- WebSocket traffic metrics (see metrics.py) ---
+# Payload sizes are the length of the JSON text, which is the byte count for ASCII payloads
+WS_MESSAGES = registry.counter("websocket_messages_total", "WebSocket messages by direction", ("direction",))
+WS_BYTES = registry.counter("websocket_message_bytes_total", "WebSocket message payload size by direction", ("direction",))
+MESSAGES_IN, MESSAGES_OUT = WS_MESSAGES.labels("in"), WS_MESSAGES.labels("out")
+BYTES_IN, BYTES_OUT = WS_BYTES.labels("in"), WS_BYTES.labels("out")
+
+async def receive_json(websocket: WebSocket):
+    text = await websocket.receive_text()
+    MESSAGES_IN.inc()
+    BYTES_IN.inc(len(text))
+    return json_codec.loads(text)
+
+def parse_batch_options(batch) -> Optional[Tuple[int, float]]:
+    """(max_messages, window_ms) for a batch negotiation, clamped; None if a field is not a number."""
+    if not batch:
+        return 1, 0.0
+    options = batch if isinstance(batch, dict) else {}
+    max_messages = options.get("max_messages", 16)
+    window_ms = options.get("window_ms", 10)
+    # bool is an int subclass, and NaN/inf would survive the clamps below
+    if not isinstance(max_messages, int) or isinstance(max_messages, bool):
+        return None
+    if not isinstance(window_ms, (int, float)) or isinstance(window_ms, bool) or not math.isfinite(window_ms):
+        return None
+    return min(max(max_messages, 2), 100), min(max(float(window_ms), 0.0), 100.0)
+
 # --- Connection Manager ---
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.rooms = {}  # room_id -> list of websockets
-        self.max_connections = 100  # Increased maximum concurrent connections
+    def __init__(
+        self,
+        max_connections: int = 100,
+        queue_size: int = 256,
+        overflow_policy: str = "drop_oldest",
+        pubsub: Optional[RoomPubSub] = None
+    ):
+        # Everything is indexed by connection id (id(websocket)) so membership
+        # checks, joins and leaves stay O(1) regardless of connection count
+        self.active_connections: Dict[int, WebSocket] = {}
+        self.rooms: Dict[str, Dict[int, WebSocket]] = {}  # room_id -> {connection id: websocket}
+        self.connection_rooms: Dict[int, Set[str]] = {}  # connection id -> room ids
+        self.max_connections = max_connections  # Maximum concurrent connections
         self.connection_timeout = 120  # 2 minutes timeout for inactive connections
-        self.last_activity = {}  # Track last activity for each connection
+        self.send_timeout = 5.0  # Seconds a single send may take before the client counts as a slow consumer
+        self.broadcast_concurrency = 256  # Maximum sends in flight per broadcast
+        # Each connection gets a bounded send queue drained by its own writer task
+        self.outboxes: Dict[int, OutboundQueue] = {}
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy  # block, drop_oldest or disconnect
+        # connection id -> last activity time, least recently active first
+        self.last_activity: "OrderedDict[int, float]" = OrderedDict()
         self.cleanup_task = None
+        # Carries room broadcasts to the managers in other worker processes (see room_pubsub.py)
+        self.pubsub = pubsub or InProcessPubSub()
 
     async def start_cleanup_task(self):
         if self.cleanup_task is None:
@@ -55,28 +127,19 @@ class ConnectionManager:
             await asyncio.sleep(30)  # Run cleanup every 30 seconds
 
     async def connect(self, websocket: WebSocket, room_id: str = "default"):
+        # Idle connections are expired by periodic_cleanup, not on the connect path
         await self.start_cleanup_task()
         
-        # Clean up inactive connections before checking max limit
-        await self.cleanup_inactive_connections()
-        
         if len(self.active_connections) >= self.max_connections:
+            logger.limited(logging.WARNING, "ws.rejected", reason="capacity", active=len(self.active_connections))
             await websocket.close(code=1008, reason="Server at maximum capacity")
             return
             
         await websocket.accept()
-        self.active_connections.append(websocket)
-        self.last_activity[id(websocket)] = asyncio.get_event_loop().time()
-        
-        print(f"Connected websocket: {id(websocket)} to room: {room_id}")
-        print(f"Active connections: {len(self.active_connections)}")
-        
-        if room_id not in self.rooms:
-            self.rooms[room_id] = []
-        self.rooms[room_id].append(websocket)
+        self.register(websocket, room_id)
+        logger.limited(logging.INFO, "ws.connected", connection=id(websocket), room=room_id, active=len(self.active_connections))
         
         # Send connection confirmation
-        print(f"Sending connect message to websocket: {id(websocket)}")
         await self.send_personal_message({
             "type": "connect",
             "data": {
@@ -87,7 +150,6 @@ class ConnectionManager:
         }, websocket)
         
         # Send a simple ping to test connection
-        print(f"Sending ping message to websocket: {id(websocket)}")
         await self.send_personal_message({
             "type": "ping",
             "data": {
@@ -106,113 +168,263 @@ class ConnectionManager:
             }
         }, room_id, exclude_websocket=websocket)
 
-    def disconnect(self, websocket: WebSocket):
+    def register(self, websocket: WebSocket, room_id: str):
+        """Track an accepted websocket and start its writer task."""
+        connection_id = id(websocket)
+        self.active_connections[connection_id] = websocket
+        self.outboxes[connection_id] = OutboundQueue(
+            websocket.send_text,
+            on_error=lambda reason: self.disconnect(websocket, code=1008, reason=reason),
+            maxsize=self.queue_size,
+            policy=self.overflow_policy,
+            send_timeout=self.send_timeout
+        )
+        self.touch(websocket)
+        self.join_room(websocket, room_id)
+
+    def join_room(self, websocket: WebSocket, room_id: str):
+        connection_id = id(websocket)
+        if room_id not in self.rooms:
+            self.rooms[room_id] = {}
+            self.pubsub.subscribe(room_id)
+        self.rooms[room_id][connection_id] = websocket
+        self.connection_rooms.setdefault(connection_id, set()).add(room_id)
+
+    def remove_connection(self, websocket: WebSocket):
+        """Drop all bookkeeping for a connection without closing it."""
+        connection_id = id(websocket)
+        self.active_connections.pop(connection_id, None)
+        self.last_activity.pop(connection_id, None)
+        outbox = self.outboxes.pop(connection_id, None)
+        if outbox is not None:
+            outbox.close()
+        for room_id in self.connection_rooms.pop(connection_id, ()):
+            members = self.rooms.get(room_id)
+            if members is not None:
+                members.pop(connection_id, None)
+                # Free empty rooms
+                if not members:
+                    del self.rooms[room_id]
+                    self.pubsub.unsubscribe(room_id)
+
+    def disconnect(self, websocket: WebSocket, code: int = 1000, reason: str = "Normal closure"):
         try:
-            logger.info(f"Disconnecting websocket: {id(websocket)}")
-            
-            if websocket in self.active_connections:
-                self.active_connections.remove(websocket)
-                # Remove from last activity tracking
-                if id(websocket) in self.last_activity:
-                    del self.last_activity[id(websocket)]
-                logger.info(f"Removed from active connections. Active: {len(self.active_connections)}")
-            
-            # Remove from all rooms
-            for room_id, connections in self.rooms.items():
-                if websocket in connections:
-                    connections.remove(websocket)
-                    logger.info(f"Removed from room: {room_id}")
+            self.remove_connection(websocket)
+            logger.limited(logging.INFO, "ws.disconnected", connection=id(websocket), code=code, reason=reason, active=len(self.active_connections))
             
             # Try to close the websocket if it's still open
             if isinstance(websocket, WebSocket) and websocket.client_state != WebSocketState.DISCONNECTED:
-                asyncio.create_task(websocket.close(code=1000, reason="Normal closure"))
+                asyncio.create_task(websocket.close(code=code, reason=reason))
                 
         except Exception as e:
-            logger.error(f"Error during disconnect: {str(e)}")
-            # Ensure connection is removed even if there's an error
-            if websocket in self.active_connections:
-                self.active_connections.remove(websocket)
-                print(f"Removed from room: {room_id}")
-                # Don't broadcast user left after disconnect to avoid ASGI errors
+            logger.error("ws.disconnect_failed", connection=id(websocket), error=str(e))
+            # Don't broadcast user left after disconnect to avoid ASGI errors
+
+    def touch(self, websocket: WebSocket):
+        """Record activity; the connection moves to the back of the expiry order."""
+        connection_id = id(websocket)
+        self.last_activity[connection_id] = asyncio.get_event_loop().time()
+        self.last_activity.move_to_end(connection_id)
 
     async def cleanup_inactive_connections(self):
-        current_time = asyncio.get_event_loop().time()
-        for websocket in self.active_connections[:]:  # Create a copy to avoid modification during iteration
-            if id(websocket) in self.last_activity:
-                if current_time - self.last_activity[id(websocket)] > self.connection_timeout:
-                    try:
-                        await websocket.close(code=1000, reason="Connection timeout")
-                    except Exception as e:
-                        print(f"Error closing connection: {e}")
-                    finally:
-                        self.disconnect(websocket)
+        # last_activity is ordered least recently active first, so only the
+        # expired prefix is visited: the sweep costs O(expired), not O(connections)
+        deadline = asyncio.get_event_loop().time() - self.connection_timeout
+        expired = []
+        for connection_id, last_activity in self.last_activity.items():
+            if last_activity > deadline:
+                break
+            expired.append(connection_id)
+
+        for connection_id in expired:
+            websocket = self.active_connections.get(connection_id)
+            if websocket is None:
+                self.last_activity.pop(connection_id, None)
+                continue
+            try:
+                await websocket.close(code=1000, reason="Connection timeout")
+            except Exception as e:
+                logger.warning("ws.close_failed", connection=connection_id, error=str(e))
+            finally:
+                self.disconnect(websocket)
 
     async def send_personal_message(self, message: dict, websocket: WebSocket):
-        if not websocket or websocket not in self.active_connections:
-            logger.warning(f"WebSocket {id(websocket)} not in active connections, skipping message")
+        if not websocket or id(websocket) not in self.active_connections:
+            logger.limited(logging.WARNING, "ws.send_skipped", connection=id(websocket), reason="not connected")
             return False
             
         if not message:
-            logger.error("Attempted to send empty message")
+            logger.limited(logging.ERROR, "ws.send_skipped", connection=id(websocket), reason="empty message")
             return False
             
         # Update last activity time
-        self.last_activity[id(websocket)] = asyncio.get_event_loop().time()
-        
-        # Cleanup inactive connections periodically
-        await self.cleanup_inactive_connections()
+        self.touch(websocket)
         
         try:
             # Check if websocket is still open
             if isinstance(websocket, WebSocket) and websocket.client_state != WebSocketState.DISCONNECTED:
-                logger.info(f"Sending message to websocket: {id(websocket)}")
-                await websocket.send_text(json.dumps(message))
-                logger.info(f"Message sent successfully to websocket: {id(websocket)}")
-                return True
+                # The writer task does the actual send, so a slow client never stalls the caller
+                outbox = self.outboxes[id(websocket)]
+                payload = json_codec.dumps_str(message)
+                if outbox.policy == "block":
+                    await asyncio.wait_for(outbox.put(payload, message.get("type", "")), self.send_timeout)
+                else:
+                    outbox.put_nowait(payload, message.get("type", ""))
+                MESSAGES_OUT.inc()
+                BYTES_OUT.inc(len(payload))
+                logger.sampled("ws.message_out", type=message.get("type", ""), size=len(payload), queued=len(outbox))
+                # A dropped progress frame is not a failure; only a closed connection is
+                return not outbox.closed
             else:
-                logger.warning(f"WebSocket {id(websocket)} is disconnected, removing from active connections")
+                logger.limited(logging.WARNING, "ws.send_skipped", connection=id(websocket), reason="disconnected")
                 self.disconnect(websocket)
                 return False
                 
+        except asyncio.TimeoutError:
+            logger.limited(logging.WARNING, "ws.slow_consumer", connection=id(websocket))
+            self.disconnect(websocket, code=1008, reason="Slow consumer")
+            return False
         except Exception as e:
-            logger.error(f"Error sending message to websocket {id(websocket)}: {str(e)}")
+            logger.limited(logging.ERROR, "ws.send_failed", connection=id(websocket), error=str(e))
             # Remove websocket on any error
             self.disconnect(websocket)
             return False
 
+    def configure_batching(self, websocket: WebSocket, max_messages: int, window: float):
+        outbox = self.outboxes.get(id(websocket))
+        if outbox is not None:
+            outbox.configure_batching(max_messages, window)
+
+    async def wait_for_client(self, websocket: WebSocket):
+        """Backpressure point: waits only while this client's send queue is backed up."""
+        outbox = self.outboxes.get(id(websocket))
+        if outbox is not None:
+            await outbox.wait_drained()
+
     async def broadcast_to_room(self, message: dict, room_id: str, exclude_websocket: WebSocket = None):
+        # Encoded once: the same text goes to local members and, via pub/sub, to other workers
+        payload = json_codec.dumps_str(message)
+        message_type = message.get("type", "")
         if room_id in self.rooms:
-            for connection in self.rooms[room_id]:
-                if connection != exclude_websocket and connection in self.active_connections:
-                    try:
-                        await connection.send_text(json.dumps(message))
-                    except Exception as e:
-                        print(f"Error broadcasting to room: {e}")
-                        # Remove problematic connection
-                        if connection in self.active_connections:
-                            self.active_connections.remove(connection)
-                        if connection in self.rooms[room_id]:
-                            self.rooms[room_id].remove(connection)
+            connections = [
+                connection for connection in self.rooms[room_id].values()
+                if connection is not exclude_websocket
+            ]
+            await self.fan_out(payload, connections, message_type)
+        await self.pubsub.publish(room_id, message_type, payload)
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections[:]:  # Copy list to avoid modification during iteration
-            try:
-                await connection.send_text(json.dumps(message))
-            except Exception as e:
-                print(f"Error broadcasting: {e}")
-                # Remove problematic connection
-                if connection in self.active_connections:
-                    self.active_connections.remove(connection)
-                # Remove from all rooms
-                for room_id, connections in self.rooms.items():
-                    if connection in connections:
-                        connections.remove(connection)
+        payload = json_codec.dumps_str(message)
+        message_type = message.get("type", "")
+        await self.fan_out(payload, list(self.active_connections.values()), message_type)
+        await self.pubsub.publish(BROADCAST_ROOM, message_type, payload)
+
+    async def deliver(self, room_id: str, message_type: str, payload: str):
+        """Pub/sub handler: fan out a frame another worker published to this worker's members."""
+        if room_id == BROADCAST_ROOM:
+            await self.fan_out(payload, list(self.active_connections.values()), message_type)
+        elif room_id in self.rooms:
+            await self.fan_out(payload, list(self.rooms[room_id].values()), message_type)
+
+    async def fan_out(self, payload: str, connections: List[WebSocket], message_type: str = ""):
+        """Queue an already-encoded payload for many connections concurrently.
+
+        Queueing only waits when a connection uses the ``block`` overflow
+        policy and its queue is full. At most ``broadcast_concurrency`` such
+        waits are in flight at once, and one that exceeds ``send_timeout``
+        evicts that connection as a slow consumer instead of holding up the
+        rest of the room.
+        """
+        if self.overflow_policy != "block":
+            queued = 0
+            for connection in connections:
+                outbox = self.outboxes.get(id(connection))
+                if outbox is not None:
+                    outbox.put_nowait(payload, message_type)
+                    queued += 1
+            MESSAGES_OUT.inc(queued)
+            BYTES_OUT.inc(queued * len(payload))
+            return
 
-manager = ConnectionManager()
+        pending = iter(connections)
+
+        async def worker():
+            for connection in pending:
+                outbox = self.outboxes.get(id(connection))
+                if outbox is None:
+                    continue
+                try:
+                    await asyncio.wait_for(outbox.put(payload, message_type), self.send_timeout)
+                    MESSAGES_OUT.inc()
+                    BYTES_OUT.inc(len(payload))
+                except asyncio.TimeoutError:
+                    logger.limited(logging.WARNING, "ws.slow_consumer", connection=id(connection))
+                    self.disconnect(connection, code=1008, reason="Slow consumer")
+                except Exception as e:
+                    logger.limited(logging.ERROR, "ws.broadcast_failed", connection=id(connection), error=str(e))
+                    # Remove problematic connection from active connections and all rooms
+                    self.remove_connection(connection)
+
+        workers = min(self.broadcast_concurrency, len(connections))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+manager = ConnectionManager(
+    max_connections=int(os.environ.get("MAX_CONNECTIONS", 100)),
+    queue_size=int(os.environ.get("OUTBOUND_QUEUE_SIZE", 256)),
+    overflow_policy=os.environ.get("OUTBOUND_OVERFLOW_POLICY", "drop_oldest"),
+    pubsub=create_room_pubsub()
+)
+
+# Connection and queue gauges are read from the manager at scrape time
+registry.gauge_callback("websocket_connections", "Open WebSocket connections", lambda: len(manager.active_connections))
+registry.gauge_callback("websocket_rooms", "Rooms with at least one connection", lambda: len(manager.rooms))
+registry.gauge_callback(
+    "websocket_outbound_queued",
+    "Frames waiting in the per-connection send queues",
+    lambda: sum(len(outbox) for outbox in manager.outboxes.values())
+)
+registry.counter_callback(
+    "room_pubsub_frames_total",
+    "Room frames exchanged with other workers",
+    lambda: {
+        ("published",): manager.pubsub.published,
+        ("received",): manager.pubsub.received,
+        ("dropped",): manager.pubsub.dropped,
+        ("invalid",): manager.pubsub.invalid,
+    },
+    ("outcome",)
+)
+register_agent_pools(agent_executor)
+register_stage_cache(stage_cache)
+registry.counter_callback("log_records_dropped_total", "Log records dropped because the log queue was full", lambda: log_handler.dropped)
+
+# Seconds each demo agent blocks its executor thread (0 = instant)
+MOCK_AGENT_SECONDS = float(os.environ.get("MOCK_AGENT_SECONDS", 0))
+# Seconds between the chunks of streamed agent output
+MOCK_TOKEN_DELAY = float(os.environ.get("MOCK_TOKEN_DELAY", 0))
+
+background_tasks: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    background_tasks.append(asyncio.create_task(run_sweeper(stage_cache)))
+    loop_watchdog.start()
+    await manager.pubsub.start(manager.deliver)
+
+@app.on_event("shutdown")
+async def close_stage_cache():
+    for task in background_tasks:
+        task.cancel()
+    loop_watchdog.stop()
+    await manager.pubsub.close()
+    stage_cache.close()
+    agent_executor.shutdown()
 
 # --- WebSocket endpoint ---
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
+    # Every line logged for this connection (writer task included) carries these
+    bind(client_id=client_id, room=f"client_{client_id}")
     await manager.connect(websocket, f"client_{client_id}")
     try:
         await manager.broadcast_to_room({
@@ -227,16 +439,41 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
 
         while True:
             try:
-                data = await websocket.receive_json()
-                print(f"Received message from client {client_id}:", data)
+                data = await receive_json(websocket)
+                manager.touch(websocket)
+                logger.sampled("ws.message_in", keys=sorted(data) if isinstance(data, dict) else None)
+                
+                if not isinstance(data, dict):
+                    await manager.send_personal_message({
+                        "type": "error",
+                        "data": {"message": "Invalid message format"}
+                    }, websocket)
                 
-                if "prompt" in data:
+                elif "prompt" in data:
                     # Handle prompt message
                     await manager.send_personal_message({
                         "type": "status",
                         "data": {"message": "Processing your prompt..."}
                     }, websocket)
-                    await run_conversation(websocket, client_id)
+                    with ACTIVE_STREAMS.track():
+                        await run_conversation(websocket, client_id)
+                
+                elif "batch" in data:
+                    # Batching negotiation; clients that never send this keep single frames
+                    options = parse_batch_options(data["batch"])
+                    if options is None:
+                        await manager.send_personal_message({
+                            "type": "error",
+                            "data": {"message": "Invalid batch options: max_messages must be an integer and window_ms a number"}
+                        }, websocket)
+                        continue
+                    max_messages, window_ms = options
+                    manager.configure_batching(websocket, max_messages, window_ms / 1000)
+                    # Sent after the switch, so a batching client gets even this as an array
+                    await manager.send_personal_message({
+                        "type": "batch",
+                        "data": {"enabled": max_messages > 1, "max_messages": max_messages, "window_ms": window_ms}
+                    }, websocket)
                 
                 elif "answer" in data:
                     # Handle answer message
@@ -245,7 +482,8 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                         "type": "status",
                         "data": {"message": f"Processing your answer: {answer}"}
                     }, websocket)
-                    await run_conversation(websocket, client_id)
+                    with ACTIVE_STREAMS.track():
+                        await run_conversation(websocket, client_id)
                 
                 else:
                     await manager.send_personal_message({
@@ -261,13 +499,16 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                 continue
                 
     except WebSocketDisconnect:
-        print(f"WebSocket disconnected for client {client_id}")
+        logger.info("ws.client_disconnected")
         manager.disconnect(websocket)
     except Exception as e:
-        print(f"Error in websocket endpoint for client {client_id}: {e}")
+        logger.exception("ws.endpoint_failed", error=str(e))
         manager.disconnect(websocket)
 
 # --- Agent Conversation Handler ---
+class ConnectionLost(Exception):
+    """Raised by a pipeline stage when the client can no longer be reached."""
+
 async def run_conversation(websocket: WebSocket, client_id: str):
     
     final_data = {
@@ -286,16 +527,22 @@ async def run_conversation(websocket: WebSocket, client_id: str):
         }
         result = await manager.send_personal_message(message, websocket)
         if not result:
-            print(f"Failed to send message: {message_type}")
+            logger.limited(logging.WARNING, "conversation.send_failed", type=message_type)
         return result
 
+    # Pacing between messages: flow control by default, fixed delays in demo mode
+    async def pace(delay: float):
+        if PACING_MODE == "fixed":
+            await asyncio.sleep(delay)
+        else:
+            await manager.wait_for_client(websocket)
+
     # --- Start Clarifier conversation ---
     if not await send_message("status", {"message": "Starting Clarifier conversation..."}):
-        print("Connection lost during status message")
+        logger.info("conversation.connection_lost", during="status message")
         return  # Stop if connection lost
     
-    # Add a small delay to prevent overwhelming the client
-    await asyncio.sleep(0.5)
+    await pace(0.5)
     
     # Simulate agent responses for demo purposes
     # In production, uncomment and use your actual agent code
@@ -304,7 +551,8 @@ async def run_conversation(websocket: WebSocket, client_id: str):
         content="Start gathering requirements for a new mobile app. Only ask 3-5 critical questions that require user input."
     )
 
-    clarifier_result = await asyncio.to_thread(clarifier.invoke, {"messages": [initial_message]}, config)
+    # Blocking agent calls run on the agent's own sized pool (see agent_executor.py)
+    clarifier_result = await agent_executor.run("clarifier", clarifier.invoke, {"messages": [initial_message]}, config)
     clarifier_messages = clarifier_result["messages"]
     clarifier_response = clarifier_messages[-1].content
     """
@@ -313,31 +561,36 @@ async def run_conversation(websocket: WebSocket, client_id: str):
     clarifier_response = "I need to understand your mobile app requirements. Please answer these questions:\n1. What is the main purpose of your app?\n2. Who is your target audience?\n3. What platforms do you want to support (iOS/Android)?\n4. What is your budget range?\n5. When do you need it completed?"
     
     if not await send_message("progress", {"message": f"Clarifier (Round 1): {clarifier_response}"}):
-        print("Connection lost during progress message")
+        logger.info("conversation.connection_lost", during="progress message")
         return  # Stop if connection lost
     
-    # Add a small delay to prevent overwhelming the client
-    await asyncio.sleep(0.5)
+    await pace(0.5)
 
     # Simulate processing agent response
     # clarifier_obj = process_agent_response(clarifier_response, ClarifierResp)
-    clarifier_obj = {
-        "done": False,
-        "resp": [
-            {"question": "What is the main purpose of your app?", "answer": ""},
-            {"question": "Who is your target audience?", "answer": ""},
-            {"question": "What platforms do you want to support (iOS/Android)?", "answer": ""},
-            {"question": "What is your budget range?", "answer": ""},
-            {"question": "When do you need it completed?", "answer": ""}
-        ]
-    }
+    try:
+        with STAGE_SECONDS.labels("clarifier").time():
+            clarifier_obj = await agent_executor.run("clarifier", mock_agent, {
+                "done": False,
+                "resp": [
+                    {"question": "What is the main purpose of your app?", "answer": ""},
+                    {"question": "Who is your target audience?", "answer": ""},
+                    {"question": "What platforms do you want to support (iOS/Android)?", "answer": ""},
+                    {"question": "What is your budget range?", "answer": ""},
+                    {"question": "When do you need it completed?", "answer": ""}
+                ]
+            }, MOCK_AGENT_SECONDS)
+    except AgentTimeout as e:
+        logger.warning("agent.timeout", error=str(e))
+        await send_message("error", {"message": str(e)})
+        return
     
     if clarifier_obj:
         final_data["clarifier"] = clarifier_obj
         if not await send_message("result", {"agent": "clarifier", "data": final_data["clarifier"]}):
-            print("Connection lost during clarifier result")
+            logger.info("conversation.connection_lost", during="clarifier result")
             return
-        await asyncio.sleep(0.3)  # Small delay
+        await pace(0.3)
 
     # --- Collect user inputs ---
     user_inputs_collected = 0
@@ -347,7 +600,7 @@ async def run_conversation(websocket: WebSocket, client_id: str):
     for i in range(1, rounds):
         if clarifier_obj and clarifier_obj.get("done", False):
             if not await send_message("status", {"message": f"Clarifier finished after {i} rounds"}):
-                print("Connection lost during clarifier finished status")
+                logger.info("conversation.connection_lost", during="clarifier finished status")
                 return
             break
 
@@ -357,17 +610,16 @@ async def run_conversation(websocket: WebSocket, client_id: str):
                 if not req.get("answer") and user_inputs_collected < max_user_inputs:
                     # Send question to client
                     if not await send_message("question", {"question": req["question"]}):
-                        print("Connection lost during question")
+                        logger.info("conversation.connection_lost", during="question")
                         return
-                    await asyncio.sleep(0.3)  # Small delay
+                    await pace(0.3)
 
                     # Wait for user answer
                     try:
-                        response = await websocket.receive_text()
-                        response_data = json.loads(response)
+                        response_data = await receive_json(websocket)
                         user_answer = response_data.get("answer", "")
                     except Exception as e:
-                        print(f"Error receiving answer: {str(e)} - continuing without error message")
+                        logger.warning("conversation.answer_failed", error=str(e))
                         continue
 
                     req["answer"] = user_answer
@@ -377,87 +629,108 @@ async def run_conversation(websocket: WebSocket, client_id: str):
                     if not await send_message("status", {
                         "message": f"User inputs collected: {user_inputs_collected}/{max_user_inputs}"
                     }):
-                        print("Connection lost during user input status")
+                        logger.info("conversation.connection_lost", during="user input status")
                         return
-                    await asyncio.sleep(0.3)  # Small delay
+                    await pace(0.3)
 
         # Simulate agent processing
         if not await send_message("progress", {"message": f"Clarifier (Round {i+1}): Processing user inputs..."}):
-            print("Connection lost during progress update")
+            logger.info("conversation.connection_lost", during="progress update")
             return
-        await asyncio.sleep(0.3)  # Small delay
+        await pace(0.3)
+
+    # --- Product, customer, engineer and risk agents ---
+    # Stages declare their inputs; customer/engineer/risk only need the
+    # clarifier and product output, so they run concurrently.
+    async def product_stage(inputs: dict):
+        if not await send_message("status", {"message": "Generating Product response..."}):
+            raise ConnectionLost("product status")
+        await pace(0.3)
+
+        # Simulate a streamed product response; each chunk reaches the
+        # client as a delta message before the full result
+        product_response = ""
+        async for chunk in mock_streaming_agent(
+            "Based on your requirements, here are the key features:\n1. User authentication system\n2. Core app functionality\n3. Push notifications\n4. Offline support\n5. Analytics dashboard",
+            MOCK_TOKEN_DELAY,
+            words_per_chunk=4
+        ):
+            product_response += chunk
+            yield chunk
+
+        if not await send_message("progress", {"message": f"Product Response: {product_response}"}):
+            raise ConnectionLost("product progress")
+        await pace(0.3)
+        yield {"features": product_response.split("\n")[1:]}
+
+    def agent_stage(label: str, result: dict):
+        async def stage(inputs: dict):
+            if not await send_message("status", {"message": f"Generating {label} response..."}):
+                raise ConnectionLost(f"{label.lower()} status")
+            await pace(0.3)
+            return await agent_executor.run(label.lower(), mock_agent, result, MOCK_AGENT_SECONDS)
+        return stage
+
+    stages = [
+        Stage("product", product_stage, ("clarifier",)),
+        Stage("customer", agent_stage("Customer", {"feedback": "Positive feedback on proposed features"}), ("clarifier", "product")),
+        Stage("engineer", agent_stage("Engineer", {"analysis": "Technical feasibility confirmed"}), ("clarifier", "product")),
+        Stage("risk", agent_stage("Risk", {"assessment": "Low risk, standard development approach recommended"}), ("clarifier", "product")),
+    ]
+
+    # Repeated answers are served from the stage cache without rerunning the agents
+    answers = [req.get("answer") for req in (clarifier_obj or {}).get("resp", [])]
+    stages = stage_cache.wrap(time_stages(stages, STAGE_SECONDS), None, answers)
 
-    # --- Product agent ---
-    if not await send_message("status", {"message": "Generating Product response..."}):
-        print("Connection lost during product status")
-        return
-    await asyncio.sleep(0.3)  # Small delay
-    
-    # Simulate product response
-    product_response = "Based on your requirements, here are the key features:\n1. User authentication system\n2. Core app functionality\n3. Push notifications\n4. Offline support\n5. Analytics dashboard"
-    
-    if not await send_message("progress", {"message": f"Product Response: {product_response}"}):
-        print("Connection lost during product progress")
-        return
-    await asyncio.sleep(0.3)  # Small delay
-
-    final_data["product"] = {"features": product_response.split("\n")[1:]}
-    if not await send_message("result", {"agent": "product", "data": final_data["product"]}):
-        print("Connection lost during product result")
-        return
-    await asyncio.sleep(0.3)  # Small delay
-
-    # --- Customer agent ---
-    if not await send_message("status", {"message": "Generating Customer response..."}):
-        print("Connection lost during customer status")
-        return
-    await asyncio.sleep(0.3)  # Small delay
-    final_data["customer"] = {"feedback": "Positive feedback on proposed features"}
-    if not await send_message("result", {"agent": "customer", "data": final_data["customer"]}):
-        print("Connection lost during customer result")
-        return
-    await asyncio.sleep(0.3)  # Small delay
-
-    # --- Engineer agent ---
-    if not await send_message("status", {"message": "Generating Engineer response..."}):
-        print("Connection lost during engineer status")
-        return
-    await asyncio.sleep(0.3)  # Small delay
-    final_data["engineer"] = {"analysis": "Technical feasibility confirmed"}
-    if not await send_message("result", {"agent": "engineer", "data": final_data["engineer"]}):
-        print("Connection lost during engineer result")
-        return
-    await asyncio.sleep(0.3)  # Small delay
-
-    # --- Risk agent ---
-    if not await send_message("status", {"message": "Generating Risk response..."}):
-        print("Connection lost during risk status")
+    try:
+        # Push each result to the client as soon as its stage finishes
+        async for stage_result in run_stages(stages, {"clarifier": final_data["clarifier"]}, deltas=True):
+            if isinstance(stage_result, StageDelta):
+                if not await send_message("delta", {"agent": stage_result.stage, "delta": stage_result.text}):
+                    raise ConnectionLost(f"{stage_result.stage} delta")
+                await pace(0)
+                continue
+            final_data[stage_result.stage] = stage_result.data
+            if not await send_message("result", {"agent": stage_result.stage, "data": stage_result.data}):
+                raise ConnectionLost(f"{stage_result.stage} result")
+            await pace(0.3)
+    except ConnectionLost as e:
+        logger.info("conversation.connection_lost", during=str(e))
         return
-    await asyncio.sleep(0.3)  # Small delay
-    final_data["risk"] = {"assessment": "Low risk, standard development approach recommended"}
-    if not await send_message("result", {"agent": "risk", "data": final_data["risk"]}):
-        print("Connection lost during risk result")
+    except AgentTimeout as e:
+        logger.warning("agent.timeout", error=str(e))
+        await send_message("error", {"message": str(e)})
         return
-    await asyncio.sleep(0.3)  # Small delay
 
     # --- Final merged JSON ---
     if not await send_message("status", {"message": "✅ Final Merged JSON generated"}):
-        print("Connection lost during final status")
+        logger.info("conversation.connection_lost", during="final status")
         return
-    await asyncio.sleep(0.3)  # Small delay
+    await pace(0.3)
     if not await send_message("result", {"agent": "final", "data": final_data}):
-        print("Connection lost during final result")
+        logger.info("conversation.connection_lost", during="final result")
         return
-    await asyncio.sleep(0.3)  # Small delay
+    await pace(0.3)
 
     # --- Final Summary ---
     if not await send_message("status", {"message": "Generating Final Summary..."}):
-        print("Connection lost during summary status")
+        logger.info("conversation.connection_lost", during="summary status")
+        return
+    await pace(0.3)
+    try:
+        with STAGE_SECONDS.labels("summary").time():
+            summary = await agent_executor.run(
+                "summarizer",
+                mock_agent,
+                "Project requirements gathered successfully. Ready for development phase.",
+                MOCK_AGENT_SECONDS
+            )
+    except AgentTimeout as e:
+        logger.warning("agent.timeout", error=str(e))
+        await send_message("error", {"message": str(e)})
         return
-    await asyncio.sleep(0.3)  # Small delay
-    summary = "Project requirements gathered successfully. Ready for development phase."
     if not await send_message("complete", {"summary": summary}):
-        print("Connection lost during complete message")
+        logger.info("conversation.connection_lost", during="complete message")
         return
 
 # --- Health check endpoint ---
@@ -466,7 +739,8 @@ async def health_check():
     return {
         "status": "ok",
         "timestamp": asyncio.get_event_loop().time(),
-        "connections": len(manager.active_connections)
+        "connections": len(manager.active_connections),
+        "stage_cache": stage_cache.stats()
     }
 
 # --- Socket info endpoint ---
@@ -477,8 +751,45 @@ async def socket_info():
         "version": "1.0.0",
         "connections": len(manager.active_connections),
         "rooms": len(manager.rooms),
+        "queued_messages": sum(len(outbox) for outbox in manager.outboxes.values()),
+        "pubsub": manager.pubsub.stats(),
         "timestamp": asyncio.get_event_loop().time()
     }
 
+# --- Agent executor pools ---
+@app.get("/socket-info/agents")
+async def socket_agents():
+    return agent_executor.stats()
+
+# --- Per-connection send queue depths ---
+@app.get("/socket-info/queues")
+async def socket_queues():
+    return {
+        "overflow_policy": manager.overflow_policy,
+        "queue_size": manager.queue_size,
+        "connections": {
+            str(connection_id): outbox.stats() for connection_id, outbox in manager.outboxes.items()
+        }
+    }
+
+# --- Prometheus metrics ---
+@app.get("/metrics")
+async def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+# --- Event loop watchdog (see loop_watchdog.py) ---
+@app.get("/debug/loop")
+async def debug_loop(stacks: bool = True):
+    return loop_watchdog.stats(stacks)
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # log_config=None sends uvicorn's own logging through the same queue
+    host, port = os.environ.get("HOST", "0.0.0.0"), int(os.environ.get("PORT", 8000))
+    workers = int(os.environ.get("WORKERS", 1))
+    if workers > 1:
+        if manager.pubsub.backend == "memory":
+            logger.warning("pubsub.process_local", workers=workers, hint="set ROOM_PUBSUB=local or redis so rooms span workers")
+        # Workers import the app themselves; rooms span them through ROOM_PUBSUB=local or redis
+        uvicorn.run("python-socket-server:app", host=host, port=port, workers=workers, log_config=None)
+    else:
+        uvicorn.run(app, host=host, port=port, log_config=None)
\ No newline at end of file
@@ -0,0 +1,505 @@
+"""
+Room fan-out across worker processes.
+
+ConnectionManager.rooms only holds the sockets of one process. A room
+broadcast is delivered to the local members directly and published once on
+a pub/sub bus. Every other node with members in the room receives the
+already-encoded frame and fans it out to its own sockets. The publisher
+encodes the JSON once, and each receiving node decodes the frame to text
+once; nothing is done per subscriber.
+
+Backends (ROOM_PUBSUB):
+
+    memory  nodes in one process share an InProcessHub (default; a single
+            worker needs nothing more)
+    local   workers on one machine meet at a broker on a Unix socket
+            (ROOM_PUBSUB_PATH). The worker holding the lock file runs the
+            broker; if it exits, another worker takes over.
+    redis   a Redis server (REDIS_URL), for workers on several machines
+
+The local broker speaks the part of the Redis protocol the nodes use
+(SUBSCRIBE, UNSUBSCRIBE, PUBLISH, PING), so both network backends share one
+client. ``python room_pubsub.py --port 6390`` runs the broker on TCP as a
+stand-in Redis for testing.
+
+Delivery is at most once, like Redis pub/sub: frames published while a node
+is reconnecting, or while its connection to the bus is backed up, are
+dropped and counted. Received frames are queued per room and each room is
+drained by its own task, so a slow room on this node holds up neither
+reading the bus nor the other rooms. Once MAX_INBOX frames are waiting,
+further frames are dropped and counted too.
+"""
+
+import argparse
+import asyncio
+import fcntl
+import logging
+import os
+import tempfile
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+from uuid import uuid4
+
+from structured_log import get_logger
+
+# Room that every node is subscribed to, for ConnectionManager.broadcast
+BROADCAST_ROOM = "__all__"
+CHANNEL_PREFIX = b"rooms:"
+# Bytes a node lets queue up towards the bus before it drops publishes
+MAX_PENDING_BYTES = 16 * 1024 * 1024
+# Received frames waiting to be fanned out before a node drops them
+MAX_INBOX = 10000
+
+Handler = Callable[[str, str, str], Awaitable[None]]  # (room, message type, payload)
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+logger = get_logger("room_pubsub")
+
+
+class RoomPubSub:
+    """Base class; a backend delivers frames published by other nodes to ``handler``."""
+
+    backend = "none"
+
+    def __init__(self, max_inbox: int = MAX_INBOX):
+        self.node_id = uuid4().hex
+        self.handler: Optional[Handler] = None
+        self.rooms: Set[str] = {BROADCAST_ROOM}
+        self.max_inbox = max_inbox
+        # room -> frames waiting for that room's delivery task, in arrival order
+        self.inbox: Dict[str, Deque[Tuple[str, str]]] = {}
+        self.queued = 0
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.invalid = 0
+        self._delivery_tasks: Set[asyncio.Task] = set()
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+
+    async def close(self):
+        for task in list(self._delivery_tasks):
+            task.cancel()
+
+    def subscribe(self, room: str):
+        self.rooms.add(room)
+
+    def unsubscribe(self, room: str):
+        self.rooms.discard(room)
+
+    async def publish(self, room: str, message_type: str, payload: str):
+        """Send an encoded frame to the other nodes' members of ``room``."""
+        raise NotImplementedError
+
+    def _deliver(self, room: str, message_type: str, payload: str):
+        # Never waits: the reader (or publisher, in-process) moves on to the next frame
+        self.received += 1
+        if self.handler is None:
+            return  # not started, nobody to deliver to
+        if self.queued >= self.max_inbox:
+            self.dropped += 1
+            return
+        frames = self.inbox.get(room)
+        if frames is None:
+            frames = self.inbox[room] = deque()
+            task = asyncio.create_task(self._drain(room, frames))
+            self._delivery_tasks.add(task)
+            task.add_done_callback(self._delivery_tasks.discard)
+        frames.append((message_type, payload))
+        self.queued += 1
+
+    async def _drain(self, room: str, frames: Deque[Tuple[str, str]]):
+        try:
+            while frames:
+                message_type, payload = frames.popleft()
+                self.queued -= 1
+                try:
+                    await self.handler(room, message_type, payload)
+                except Exception as e:
+                    logger.limited(logging.ERROR, "pubsub.delivery_failed", room=room, type=message_type, error=repr(e))
+        finally:
+            # No await between the last check and here, so no frame is left behind
+            self.queued -= len(frames)
+            if self.inbox.get(room) is frames:
+                del self.inbox[room]
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "backend": self.backend,
+            "node_id": self.node_id,
+            "rooms": len(self.rooms),
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+            "invalid": self.invalid,
+            "queued": self.queued,
+        }
+
+
+# --- In-process ---
+class InProcessHub:
+    def __init__(self):
+        self.nodes: List["InProcessPubSub"] = []
+
+
+class InProcessPubSub(RoomPubSub):
+    """Nodes sharing a hub in one process (several managers in a test or benchmark)."""
+
+    backend = "memory"
+
+    def __init__(self, hub: Optional[InProcessHub] = None):
+        super().__init__()
+        self.hub = hub or InProcessHub()
+        self.hub.nodes.append(self)
+
+    async def close(self):
+        await super().close()
+        if self in self.hub.nodes:
+            self.hub.nodes.remove(self)
+
+    async def publish(self, room: str, message_type: str, payload: str):
+        self.published += 1
+        for node in self.hub.nodes:
+            if node is not self and room in node.rooms:
+                node._deliver(room, message_type, payload)
+
+
+# --- Redis protocol ---
+class RespError(Exception):
+    pass
+
+
+def encode_command(*parts: bytes) -> bytes:
+    """Encode a command (or a pushed message) as a RESP array of bulk strings."""
+    out = [b"*%d\r\n" % len(parts)]
+    for part in parts:
+        out.append(b"$%d\r\n%s\r\n" % (len(part), part))
+    return b"".join(out)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        return RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Unexpected reply: {line[:40]!r}")
+
+
+class RespPubSub(RoomPubSub):
+    """Pub/sub over the Redis protocol, on one connection for publishing and one for subscriptions.
+
+    Frames carry the publishing node's id and the message type in front of
+    the payload; a node skips its own frames, which Redis echoes back when
+    it is subscribed to the room itself.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.connected: Optional[asyncio.Event] = None  # created in start(), inside the loop
+        self._pub: Optional[asyncio.StreamWriter] = None
+        self._sub: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def open_connection(self) -> Connection:
+        raise NotImplementedError
+
+    async def start(self, handler: Handler, timeout: float = 5.0):
+        await super().start(handler)
+        self.connected = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass  # keeps retrying in the background; publishes are dropped until then
+
+    async def close(self):
+        await super().close()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for writer in (self._pub, self._sub):
+            if writer is not None:
+                writer.close()
+        self._pub = self._sub = None
+
+    def subscribe(self, room: str):
+        if room not in self.rooms:
+            super().subscribe(room)
+            if self._sub is not None:
+                self._sub.write(encode_command(b"SUBSCRIBE", CHANNEL_PREFIX + room.encode()))
+
+    def unsubscribe(self, room: str):
+        if room in self.rooms:
+            super().unsubscribe(room)
+            if self._sub is not None:
+                self._sub.write(encode_command(b"UNSUBSCRIBE", CHANNEL_PREFIX + room.encode()))
+
+    async def publish(self, room: str, message_type: str, payload: str):
+        writer = self._pub
+        if writer is None or writer.transport.get_write_buffer_size() > MAX_PENDING_BYTES:
+            self.dropped += 1
+            return
+        frame = b"%s\n%s\n%s" % (self.node_id.encode(), message_type.encode(), payload.encode())
+        writer.write(encode_command(b"PUBLISH", CHANNEL_PREFIX + room.encode(), frame))
+        self.published += 1
+
+    async def _run(self):
+        delay = 0.05
+        while True:
+            pub = None
+            try:
+                pub_reader, pub = await self.open_connection()
+                sub_reader, sub = await self.open_connection()
+            except Exception as e:
+                if pub is not None:
+                    pub.close()
+                if not isinstance(e, OSError):
+                    logger.limited(logging.ERROR, "pubsub.connect_failed", backend=self.backend, error=repr(e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+                continue
+            delay = 0.05
+            channels = [CHANNEL_PREFIX + room.encode() for room in self.rooms]
+            sub.write(encode_command(b"SUBSCRIBE", *channels))
+            self._pub, self._sub = pub, sub
+            self.connected.set()
+            replies = asyncio.create_task(self._discard_replies(pub_reader))
+            try:
+                await self._read_messages(sub_reader)
+            except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                pass
+            except Exception as e:
+                # Anything else (e.g. a reply that does not parse) reconnects
+                # instead of ending cross-worker fan-out for good
+                logger.limited(logging.ERROR, "pubsub.reader_failed", backend=self.backend, error=repr(e))
+                await asyncio.sleep(delay)
+            finally:
+                self.connected.clear()
+                self._pub = self._sub = None
+                replies.cancel()
+                pub.close()
+                sub.close()
+
+    async def _discard_replies(self, reader: asyncio.StreamReader):
+        # PUBLISH replies are pipelined; only a closed connection matters
+        while True:
+            await read_reply(reader)
+
+    async def _read_messages(self, reader: asyncio.StreamReader):
+        origin_prefix = self.node_id.encode() + b"\n"
+        while True:
+            reply = await read_reply(reader)
+            if not isinstance(reply, list) or len(reply) != 3 or reply[0] != b"message":
+                continue  # subscribe/unsubscribe confirmations
+            _, channel, frame = reply
+            if not isinstance(frame, bytes) or frame.startswith(origin_prefix):
+                continue
+            try:
+                _, message_type, payload = frame.split(b"\n", 2)
+                room = channel[len(CHANNEL_PREFIX):].decode()
+                self._deliver(room, message_type.decode(), payload.decode())
+            except (ValueError, TypeError) as e:  # UnicodeDecodeError is a ValueError
+                self.invalid += 1
+                logger.limited(logging.WARNING, "pubsub.invalid_frame", channel=repr(channel)[:80], error=repr(e))
+
+    def stats(self) -> Dict[str, object]:
+        return {**super().stats(), "connected": self.connected is not None and self.connected.is_set()}
+
+
+class RedisPubSub(RespPubSub):
+    backend = "redis"
+
+    def __init__(self, url: str):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+
+    async def open_connection(self) -> Connection:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(encode_command(b"AUTH", self.password.encode()))
+            reply = await read_reply(reader)
+            if isinstance(reply, RespError):
+                writer.close()
+                raise ConnectionError(f"Redis AUTH failed: {reply}")
+        return reader, writer
+
+
+class UnixSocketPubSub(RespPubSub):
+    """Workers on one machine; whichever holds ``path``.lock runs the broker on ``path``."""
+
+    backend = "local"
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.broker: Optional["PubSubBroker"] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._lock_file = None
+
+    async def open_connection(self) -> Connection:
+        try:
+            return await asyncio.open_unix_connection(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # No broker (or a dead one's socket file); run it here if nobody else does
+            if not await self._become_broker():
+                raise
+            return await asyncio.open_unix_connection(self.path)
+
+    async def _become_broker(self) -> bool:
+        if self._server is not None:
+            return True
+        lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.broker = PubSubBroker()
+        self._server = await asyncio.start_unix_server(self.broker.handle_client, self.path)
+        self._lock_file = lock_file
+        return True
+
+    async def close(self):
+        await super().close()
+        if self._server is not None:
+            self._server.close()
+            self.broker.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._lock_file.close()  # releases the lock for the next broker
+            self._server = self._lock_file = None
+
+    def stats(self) -> Dict[str, object]:
+        stats = {**super().stats(), "path": self.path, "is_broker": self._server is not None}
+        if self.broker is not None and self._server is not None:
+            stats["broker"] = self.broker.stats()
+        return stats
+
+
+# --- Broker ---
+class PubSubBroker:
+    """Minimal Redis-protocol pub/sub server: each PUBLISH is encoded once and written to every subscriber."""
+
+    def __init__(self):
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.clients: Set[asyncio.StreamWriter] = set()
+        self.published = 0
+        self.dropped = 0
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.add(writer)
+        subscribed: Set[bytes] = set()
+        try:
+            while True:
+                command = await read_reply(reader)
+                if not isinstance(command, list) or not command:
+                    break
+                name = command[0].upper()
+                if name == b"PUBLISH" and len(command) == 3:
+                    writer.write(b":%d\r\n" % self._publish(command[1], command[2]))
+                elif name in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+                    for channel in command[1:]:
+                        if name == b"SUBSCRIBE":
+                            self.channels.setdefault(channel, set()).add(writer)
+                            subscribed.add(channel)
+                        else:
+                            self._remove(channel, writer)
+                            subscribed.discard(channel)
+                        writer.write(
+                            b"*3\r\n$%d\r\n%s\r\n$%d\r\n%s\r\n:%d\r\n"
+                            % (len(name), name.lower(), len(channel), channel, len(subscribed))
+                        )
+                elif name == b"PING":
+                    writer.write(b"+PONG\r\n")
+                else:
+                    writer.write(b"-ERR unsupported command\r\n")
+        except (ConnectionError, asyncio.IncompleteReadError, OSError, ValueError, asyncio.CancelledError):
+            pass  # client gone, or the broker is shutting down
+        finally:
+            for channel in subscribed:
+                self._remove(channel, writer)
+            self.clients.discard(writer)
+            writer.close()
+
+    def _publish(self, channel: bytes, data: bytes) -> int:
+        subscribers = self.channels.get(channel)
+        if not subscribers:
+            return 0
+        self.published += 1
+        message = encode_command(b"message", channel, data)
+        for subscriber in subscribers:
+            if subscriber.transport.get_write_buffer_size() > MAX_PENDING_BYTES:
+                self.dropped += 1
+                continue
+            subscriber.write(message)
+        return len(subscribers)
+
+    def _remove(self, channel: bytes, writer: asyncio.StreamWriter):
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.channels[channel]
+
+    def close(self):
+        for writer in list(self.clients):
+            writer.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {"clients": len(self.clients), "channels": len(self.channels), "published": self.published, "dropped": self.dropped}
+
+
+def create_room_pubsub() -> RoomPubSub:
+    """Build the backend selected by ROOM_PUBSUB (memory, local or redis)."""
+    backend = os.environ.get("ROOM_PUBSUB", "memory")
+    if backend == "memory":
+        return InProcessPubSub()
+    if backend == "local":
+        return UnixSocketPubSub(os.environ.get("ROOM_PUBSUB_PATH", os.path.join(tempfile.gettempdir(), "room_pubsub.sock")))
+    if backend == "redis":
+        return RedisPubSub(os.environ.get("REDIS_URL", "redis://localhost:6379"))
+    raise ValueError(f"Unknown ROOM_PUBSUB backend: {backend}")
+
+
+async def serve_broker(host: str, port: int, path: Optional[str]):
+    broker = PubSubBroker()
+    if path:
+        server = await asyncio.start_unix_server(broker.handle_client, path)
+        print(f"Room pub/sub broker listening on {path}")
+    else:
+        server = await asyncio.start_server(broker.handle_client, host, port)
+        print(f"Room pub/sub broker listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Standalone room pub/sub broker (a stand-in Redis for pub/sub)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+    args = parser.parse_args()
+    asyncio.run(serve_broker(args.host, args.port, args.unix))
@@ -0,0 +1,99 @@
+"""
+Request coalescing for duplicate in-flight work.
+
+``SingleFlight.stream(key, factory)`` starts ``factory()`` (an async iterator)
+only if no flight for ``key`` is running; concurrent callers with the same key
+subscribe to the running one instead. Every subscriber sees every item from
+the start, including the ones produced before it joined, and then follows
+live ones. The source runs in its own task, so a subscriber that goes away
+does not stop it for the others; it is cancelled only when the last
+subscriber leaves early.
+"""
+
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+
+class FlightCancelled(Exception):
+    """The shared source was cancelled before it finished."""
+
+
+class Flight:
+    def __init__(self, key: str, source: AsyncIterator[Any], on_done: Callable[["Flight"], None]):
+        self.key = key
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._on_done = on_done
+        self._updated = asyncio.Event()
+        self._task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator[Any]):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = FlightCancelled(self.key)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._on_done(self)
+            self._notify()
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def subscribe(self) -> AsyncIterator[Any]:
+        # Counted now rather than on first iteration, so a subscriber that has
+        # not started reading yet still keeps the flight alive
+        self.subscribers += 1
+        return self._follow()
+
+    async def _follow(self) -> AsyncIterator[Any]:
+        index = 0
+        try:
+            while True:
+                while index < len(self.items):
+                    yield self.items[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._updated.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._task.cancel()
+                # Land now, not when the cancelled task next runs: a duplicate
+                # request arriving in between must start a fresh flight
+                self._on_done(self)
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.started = 0
+        self.joined = 0
+
+    def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """Iterate the flight for ``key``, starting ``factory()`` if none is in flight."""
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight(key, factory(), self._land)
+            self.started += 1
+        else:
+            self.joined += 1
+        return flight.subscribe()
+
+    def _land(self, flight: Flight):
+        # Compare identity so a finished flight never removes its successor
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self.flights), "started": self.started, "joined": self.joined}
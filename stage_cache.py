@@ -0,0 +1,154 @@
+"""
+Content-addressed cache for agent stage outputs.
+
+A stage's output depends only on the stage, the user's text input, the
+clarifier answers and the outputs of the stages it depends on, so those are
+hashed into the cache key. Answers are normalized first (surrounding and
+repeated whitespace, case) so trivially different retries still hit.
+
+Entries live in an in-memory LRU with idle TTL and, when STAGE_CACHE_DB_PATH
+is set, in a SQLite tier that survives restarts and is shared between worker
+processes. Disk hits are promoted to memory.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Sequence
+
+import json_codec
+from conversation_store import InMemoryStore, SQLiteStore
+from workflow_dag import Stage, encode_frozen, freeze
+
+
+def normalize_answer(answer: Optional[str]) -> str:
+    return " ".join((answer or "").split()).casefold()
+
+
+def stage_key(stage: str, text_input: Optional[str], answers: Iterable[Optional[str]], upstream: Dict[str, Any]) -> str:
+    """Stable hash of everything a stage's output depends on."""
+    material = json.dumps(
+        [stage, normalize_answer(text_input), [normalize_answer(answer) for answer in answers], upstream],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class StageCache:
+    def __init__(self, memory: InMemoryStore, disk: Optional[SQLiteStore] = None):
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.put(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def wrap(self, stages: Sequence[Stage], text_input: Optional[str], answers: Sequence[Optional[str]]) -> List[Stage]:
+        """Return ``stages`` with each stage function served from the cache when possible.
+
+        Seed inputs such as the clarifier output are left out of the key;
+        ``text_input`` and ``answers`` stand in for them.
+        """
+        deps = {name for stage in stages for name in stage.deps}
+        produced = {stage.name for stage in stages}
+        seeds = deps - produced
+        return [Stage(stage.name, self._cached(stage, text_input, answers, seeds), stage.deps) for stage in stages]
+
+    def _cached(self, stage: Stage, text_input: Optional[str], answers: Sequence[Optional[str]], seeds: set):
+        def key_for(inputs: Dict[str, Any]) -> str:
+            upstream = {name: value for name, value in inputs.items() if name not in seeds}
+            return stage_key(stage.name, text_input, answers, upstream)
+
+        async def run(inputs: Dict[str, Any]) -> Any:
+            key = key_for(inputs)
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            result = freeze(await stage.fn(inputs))
+            if result is not None:
+                self.put(key, result)
+            return result
+
+        async def stream(inputs: Dict[str, Any]) -> AsyncIterator[Any]:
+            # Streaming stages replay a hit as their result (a text result as one chunk)
+            key = key_for(inputs)
+            cached = self.get(key)
+            if cached is not None:
+                yield cached
+                return
+            chunks: List[str] = []
+            result = None
+            async for item in stage.fn(inputs):
+                if isinstance(item, str):
+                    chunks.append(item)
+                else:
+                    result = item
+                yield item
+            self.put(key, freeze(result if result is not None else "".join(chunks)))
+
+        return stream if inspect.isasyncgenfunction(stage.fn) else run
+
+    def sweep(self) -> None:
+        self.memory.sweep()
+        if self.disk is not None:
+            self.disk.sweep()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None,
+        }
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+
+def create_stage_cache() -> StageCache:
+    """Build the stage cache configured by the STAGE_CACHE_* environment variables."""
+    ttl = float(os.environ.get("STAGE_CACHE_TTL", 3600))
+    memory = InMemoryStore(
+        max_entries=int(os.environ.get("STAGE_CACHE_MAX_ENTRIES", 10000)),
+        ttl=ttl,
+        max_bytes=int(os.environ.get("STAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+        sizeof=lambda value: len(encode_frozen(value)),
+    )
+    disk = None
+    path = os.environ.get("STAGE_CACHE_DB_PATH")
+    if path:
+        disk = SQLiteStore(
+            path,
+            encode=lambda value: encode_frozen(value).decode(),
+            decode=lambda text: freeze(json_codec.loads(text)),
+            table="stage_cache",
+            ttl=ttl,
+        )
+    return StageCache(memory, disk)
+
+
+stage_cache = create_stage_cache()
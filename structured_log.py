@@ -0,0 +1,257 @@
+"""
+Structured logging that stays off the event loop.
+
+Records go into a bounded queue (QueueHandler) and are formatted and written
+by a QueueListener thread, so a log call on the loop costs a record and a
+queue put, never a write to stderr. When the queue is full, records are
+dropped and counted; the loop never waits on it.
+
+Output is one JSON object per line (or ``key=value`` text). Besides the event
+name and its fields, each line carries the context bound with ``bind()`` or
+``bound()`` (client_id, room, thread_id, ...). Context lives in a
+contextvar, so it follows the task that bound it and any task created from
+it, such as a connection's writer task.
+
+Per-message events use ``sampled()``: only LOG_SAMPLE_RATE of them are kept.
+Those and other hot-path lines (``limited()``) share a token bucket of
+LOG_RATE_LIMIT lines per second. The next line that gets through reports how
+many were suppressed:
+
+    LOG_LEVEL        minimum level (default INFO)
+    LOG_FORMAT       json (default) or text
+    LOG_SAMPLE_RATE  share of per-message events logged (default 0.01)
+    LOG_RATE_LIMIT   hot-path lines per second, burst included (default 100)
+    LOG_QUEUE_SIZE   records buffered for the writer thread (default 10000)
+"""
+
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from random import random
+from typing import Any, Dict, Iterator, Optional, TextIO
+
+import json_codec
+
+log_context: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("log_context", default={})
+
+
+def bind(**fields: Any) -> None:
+    """Add ``fields`` to every record logged by the current task from now on."""
+    log_context.set({**log_context.get(), **fields})
+
+
+@contextlib.contextmanager
+def bound(**fields: Any) -> Iterator[None]:
+    """Add ``fields`` to the records logged inside the block."""
+    token = log_context.set({**log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        log_context.reset(token)
+
+
+class RateLimiter:
+    """Token bucket; ``allow()`` returns None when over the limit, else the lines suppressed since the last one allowed."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+    def allow(self) -> Optional[int]:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return None
+        self.tokens -= 1
+        suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+
+class HotPath:
+    def __init__(self, sample_rate: float, rate_limit: float):
+        self.sample_rate = sample_rate
+        self.limiter = RateLimiter(rate_limit) if rate_limit > 0 else None
+
+
+hot_path = HotPath(sample_rate=1.0, rate_limit=0)
+
+
+class StructuredLogger:
+    """Logs an event name plus keyword fields; see the module docstring."""
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+
+    def log(self, level: int, event: str, **fields: Any):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, extra={"fields": fields})
+
+    def debug(self, event: str, **fields: Any):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event: str, **fields: Any):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event: str, **fields: Any):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event: str, **fields: Any):
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event: str, **fields: Any):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(event, exc_info=True, extra={"fields": fields})
+
+    def sampled(self, event: str, level: int = logging.INFO, **fields: Any):
+        """A per-message event: sampled, then rate limited."""
+        if not self.logger.isEnabledFor(level):
+            return
+        rate = hot_path.sample_rate
+        if rate < 1.0:
+            if random() >= rate:
+                return
+            fields["sample_rate"] = rate
+        self._limited(level, event, fields)
+
+    def limited(self, level: int, event: str, **fields: Any):
+        """A hot-path line that is not sampled but still rate limited (e.g. per-message warnings)."""
+        if self.logger.isEnabledFor(level):
+            self._limited(level, event, fields)
+
+    def _limited(self, level: int, event: str, fields: Dict[str, Any]):
+        if hot_path.limiter is not None:
+            suppressed = hot_path.limiter.allow()
+            if suppressed is None:
+                return
+            if suppressed:
+                fields["suppressed"] = suppressed
+        self.logger.log(level, event, extra={"fields": fields})
+
+
+def get_logger(name: str) -> StructuredLogger:
+    return StructuredLogger(name)
+
+
+# --- Handlers ---
+class ContextQueueHandler(QueueHandler):
+    """Captures the bound context and hands the record to the writer thread as-is.
+
+    Unlike the stock QueueHandler it does not format on the caller's thread;
+    only exception tracebacks are rendered here, while their frames still
+    exist.
+    """
+
+    def __init__(self, queue_: "queue.SimpleQueue", maxsize: int):
+        super().__init__(queue_)
+        self.maxsize = maxsize
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.context = log_context.get()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # SimpleQueue is lock-free for producers but unbounded, so the bound is checked here
+        if self.queue.qsize() >= self.maxsize:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", None) or {})
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        try:
+            return json_codec.dumps_str(entry)
+        except TypeError:
+            return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {**(getattr(record, "context", None) or {}), **(getattr(record, "fields", None) or {})}
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+_listener: Optional[QueueListener] = None
+_handler: Optional[ContextQueueHandler] = None
+
+
+def setup_logging(
+    level: Optional[str] = None,
+    fmt: Optional[str] = None,
+    sample_rate: Optional[float] = None,
+    rate_limit: Optional[float] = None,
+    queue_size: Optional[int] = None,
+    stream: Optional[TextIO] = None,
+) -> ContextQueueHandler:
+    """Route the root logger through the queue; arguments default to the LOG_* environment variables.
+
+    Calling it again replaces the previous setup. Loggers that propagate to
+    the root (uvicorn's too, when it runs with ``log_config=None``) all end
+    up in the same queue.
+    """
+    global _listener, _handler
+    stop_logging()
+
+    hot_path.sample_rate = sample_rate if sample_rate is not None else float(os.environ.get("LOG_SAMPLE_RATE", 0.01))
+    limit = rate_limit if rate_limit is not None else float(os.environ.get("LOG_RATE_LIMIT", 100))
+    hot_path.limiter = RateLimiter(limit) if limit > 0 else None
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(TextFormatter() if (fmt or os.environ.get("LOG_FORMAT", "json")) == "text" else JSONFormatter())
+
+    records: "queue.SimpleQueue" = queue.SimpleQueue()
+    _handler = ContextQueueHandler(records, queue_size or int(os.environ.get("LOG_QUEUE_SIZE", 10000)))
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel((level or os.environ.get("LOG_LEVEL", "INFO")).upper())
+    return _handler
+
+
+# The writer thread is a daemon; flush what is still queued when the process exits
+atexit.register(lambda: stop_logging())
+
+
+def stop_logging():
+    """Write out everything still queued and stop the writer thread."""
+    global _listener, _handler
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
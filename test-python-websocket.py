@@ -1,13 +1,38 @@
 #!/usr/bin/env python3
 """
-Simple test script for the Python WebSocket server.
-This script tests basic server functionality without requiring the full agent system.
+Test and load-generation script for the Python servers.
+
+Without arguments it runs the original smoke test against a server on
+localhost:8000 (health check plus one WebSocket exchange). The subcommands
+drive many simulated clients and report latency percentiles, throughput and
+errors:
+
+    python test-python-websocket.py ws --clients 1000 --rate 200 --start-server
+    python test-python-websocket.py http --flow workflow --concurrency 200 --sessions 5000
+    python test-python-websocket.py http --flow stream --duration 60 --start-server
+
+`ws` plays the prompt/answer protocol of python-socket-server.py until each
+conversation completes. `http` runs main.py's /start_conversation ->
+/continue_clarifier -> /run_workflow -> /get_result flow, or
+/run_workflow_stream. With --start-server the script starts the server on
+--port itself and stops it afterwards.
 """
 
+import argparse
 import asyncio
-import websockets
 import json
+import os
+import subprocess
 import sys
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+import aiohttp
+import websockets
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
 
 async def test_websocket_connection():
     """Test basic WebSocket connection and message handling."""
@@ -108,9 +133,293 @@ async def main():
     print("   2. Start Next.js: npm run dev")
     print("   3. Visit: http://localhost:3000/python-websocket-demo")
 
-if __name__ == "__main__":
+# --- Load generation ---
+
+class Stats:
+    """Latency samples per metric plus counters, shared by all simulated clients."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.counters: Counter = Counter()
+        self.errors: Counter = Counter()
+
+    def record(self, metric: str, seconds: float):
+        self.samples[metric].append(seconds)
+
+    def report(self, elapsed: float):
+        print(f"\nDuration {elapsed:.1f}s")
+        for name, value in sorted(self.counters.items()):
+            print(f"  {name:<24} {value:>10}  ({value / elapsed:,.1f}/s)")
+        print(f"\n  {'latency (ms)':<24} {'count':>8} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+        for name, values in sorted(self.samples.items()):
+            values.sort()
+            row = [percentile(values, p) * 1000 for p in (50, 90, 99)] + [values[-1] * 1000]
+            print(f"  {name:<24} {len(values):>8} " + " ".join(f"{v:>9.1f}" for v in row))
+        if self.errors:
+            print("\n  errors / close codes")
+            for name, count in self.errors.most_common():
+                print(f"  {name:<40} {count:>8}")
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Pacer:
+    """Hands out session start times at a fixed rate (unlimited when rate is 0)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0.0
+        self.next_start = time.perf_counter()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.perf_counter()
+        start = max(self.next_start, now)
+        self.next_start = start + self.interval
+        await asyncio.sleep(start - now)
+
+
+async def run_load(session_fn, stats: Stats, concurrency: int, sessions: int, duration: float, rate: float):
+    """Run ``session_fn(worker, stats)`` from ``concurrency`` workers until the session or time budget is used."""
+    pacer = Pacer(rate)
+    deadline = time.perf_counter() + duration if duration else None
+    remaining = [sessions]
+
+    async def worker(index: int):
+        while (not sessions or remaining[0] > 0) and (deadline is None or time.perf_counter() < deadline):
+            remaining[0] -= 1
+            await pacer.wait()
+            await session_fn(index, stats)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return time.perf_counter() - start
+
+
+async def ws_session(base_url: str, index: int, stats: Stats, timeout: float, batch: int):
+    uri = f"{base_url}/ws/load_{index}"
+    start = time.perf_counter()
     try:
+        async with websockets.connect(uri, open_timeout=timeout, max_queue=None) as websocket:
+            stats.record("connect", time.perf_counter() - start)
+            stats.counters["connections"] += 1
+            if batch > 1:
+                await websocket.send(json.dumps({"batch": {"max_messages": batch, "window_ms": 5}}))
+
+            sent_at = time.perf_counter()
+            await websocket.send(json.dumps({"prompt": f"Load test app {index}"}))
+            conversation_start = sent_at
+            last_message = sent_at
+            # The reply to an answer is the server's "User inputs collected: n/..."
+            # status for that answer; frames queued before it (deltas, the
+            # previous step's status) must not stop the clock early
+            answers_sent = 0
+            expected_reply = None
+            while True:
+                frame = await asyncio.wait_for(websocket.recv(), timeout)
+                now = time.perf_counter()
+                stats.counters["frames"] += 1
+                stats.counters["bytes_received"] += len(frame)
+                messages = json.loads(frame)
+                if not isinstance(messages, list):
+                    messages = [messages]
+                done = False
+                replied = False
+                for message in messages:
+                    stats.counters["messages"] += 1
+                    if (
+                        expected_reply is not None and message.get("type") == "status"
+                        and message["data"].get("message", "").startswith(expected_reply)
+                    ):
+                        stats.record("reply", now - sent_at)
+                        expected_reply = None
+                        replied = True
+                    if message.get("type") == "question":
+                        sent_at = time.perf_counter()
+                        await websocket.send(json.dumps({"answer": f"Answer from client {index}"}))
+                        answers_sent += 1
+                        expected_reply = f"User inputs collected: {answers_sent}/"
+                    elif message.get("type") == "error":
+                        stats.errors[f"error message: {message['data'].get('message', '')[:30]}"] += 1
+                    elif message.get("type") == "complete":
+                        done = True
+                if not replied:
+                    stats.record("message_gap", now - last_message)
+                last_message = now
+                if done:
+                    break
+            stats.record("conversation", time.perf_counter() - conversation_start)
+            stats.counters["conversations"] += 1
+    except websockets.ConnectionClosed as e:
+        code = e.rcvd.code if e.rcvd else "none"
+        reason = e.rcvd.reason if e.rcvd else ""
+        stats.errors[f"closed {code} {reason}".strip()] += 1
+    except asyncio.TimeoutError:
+        stats.errors["timeout"] += 1
+    except Exception as e:
+        stats.errors[type(e).__name__] += 1
+
+
+async def http_request(session: aiohttp.ClientSession, stats: Stats, name: str, method: str, url: str, **kwargs):
+    start = time.perf_counter()
+    async with session.request(method, url, **kwargs) as response:
+        body = await response.read()
+    stats.record(name, time.perf_counter() - start)
+    stats.counters["requests"] += 1
+    # Every endpoint exercised here answers 200 on success; a 202 from
+    # get_result means the long-poll ran out (the server caps it at
+    # MAX_RESULT_WAIT) and must not count as a finished workflow
+    if response.status != 200:
+        stats.errors[f"{name} HTTP {response.status}"] += 1
+        return None
+    return json.loads(body)
+
+
+async def http_workflow_session(session: aiohttp.ClientSession, base_url: str, index: int, stats: Stats, timeout: float):
+    start = time.perf_counter()
+    try:
+        started = await http_request(session, stats, "start_conversation", "POST", f"{base_url}/start_conversation",
+                                     json={"text_input": f"Load test app {index}"})
+        if started is None:
+            return
+        thread_id = started["thread_id"]
+        if await http_request(session, stats, "continue_clarifier", "POST", f"{base_url}/continue_clarifier",
+                              json={"thread_id": thread_id, "answers": ["a", "b", "c", "d"]}) is None:
+            return
+        if await http_request(session, stats, "run_workflow", "POST", f"{base_url}/run_workflow",
+                              json={"thread_id": thread_id}) is None:
+            return
+        # Long-poll instead of spinning on 202s
+        if await http_request(session, stats, "get_result", "GET", f"{base_url}/get_result/{thread_id}",
+                              params={"wait": str(timeout)}) is None:
+            return
+        stats.record("workflow", time.perf_counter() - start)
+        stats.counters["workflows"] += 1
+    except Exception as e:
+        stats.errors[type(e).__name__] += 1
+
+
+async def http_stream_session(session: aiohttp.ClientSession, base_url: str, index: int, stats: Stats, timeout: float):
+    start = time.perf_counter()
+    try:
+        async with session.post(f"{base_url}/run_workflow_stream", json={"text_input": f"Load test app {index}"}) as response:
+            if response.status >= 400:
+                stats.errors[f"run_workflow_stream HTTP {response.status}"] += 1
+                return
+            first = True
+            last_line = b""
+            async for line in response.content:
+                if first:
+                    stats.record("stream_first_line", time.perf_counter() - start)
+                    first = False
+                stats.counters["stream_lines"] += 1
+                stats.counters["bytes_received"] += len(line)
+                if line.strip():
+                    last_line = line
+        # main.py wraps each event as {"seq": n, "event": {...}}; dummy_data.py doesn't
+        last_event = json.loads(last_line) if last_line else {}
+        last_event = last_event.get("event", last_event)
+        if last_event.get("step") == "error" or last_event.get("type") == "error":
+            stats.errors[f"stream error: {str(last_event.get('error', ''))[:30]}"] += 1
+            return
+        stats.record("stream", time.perf_counter() - start)
+        stats.counters["workflows"] += 1
+    except Exception as e:
+        stats.errors[type(e).__name__] += 1
+
+
+async def wait_for_health(base_url: str, timeout: float = 15.0):
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            try:
+                async with session.get(f"{base_url}/health") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not become healthy")
+
+
+def start_server(mode: str, port: int, clients: int) -> subprocess.Popen:
+    script = "python-socket-server.py" if mode == "ws" else "main.py"
+    env = {**os.environ, "PORT": str(port), "HOST": "127.0.0.1"}
+    env.setdefault("MAX_CONNECTIONS", str(max(clients * 2, 100)))
+    print(f"Starting {script} on port {port}")
+    return subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, script)],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def load_test(args):
+    http_url = f"http://{args.host}:{args.port}"
+    server: Optional[subprocess.Popen] = None
+    if args.start_server:
+        server = start_server(args.mode, args.port, args.concurrency)
+    try:
+        await wait_for_health(http_url)
+        stats = Stats()
+        print(f"{args.mode} load: {args.concurrency} concurrent clients, "
+              f"{args.sessions or 'unlimited'} sessions, {args.duration or 'no'} duration limit, "
+              f"rate {args.rate or 'unlimited'}/s")
+
+        if args.mode == "ws":
+            ws_url = f"ws://{args.host}:{args.port}"
+            async def session_fn(index, stats):
+                await ws_session(ws_url, index, stats, args.timeout, args.batch)
+            elapsed = await run_load(session_fn, stats, args.concurrency, args.sessions, args.duration, args.rate)
+        else:
+            connector = aiohttp.TCPConnector(limit=args.concurrency)
+            client_timeout = aiohttp.ClientTimeout(total=args.timeout + 5)
+            async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+                flow = http_workflow_session if args.flow == "workflow" else http_stream_session
+                async def session_fn(index, stats):
+                    await flow(session, http_url, index, stats, args.timeout)
+                elapsed = await run_load(session_fn, stats, args.concurrency, args.sessions, args.duration, args.rate)
+        stats.report(elapsed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="mode")
+    for mode, help_text in (("ws", "WebSocket prompt/answer conversations"), ("http", "HTTP workflow endpoints")):
+        sub = subparsers.add_parser(mode, help=help_text)
+        sub.add_argument("--host", default="127.0.0.1")
+        sub.add_argument("--port", type=int, default=8000)
+        sub.add_argument("--concurrency", "--clients", type=int, default=100, help="simulated clients running at once")
+        sub.add_argument("--sessions", type=int, default=0, help="total sessions to run (default: one per client)")
+        sub.add_argument("--duration", type=float, default=0, help="stop starting sessions after this many seconds")
+        sub.add_argument("--rate", type=float, default=0, help="max new sessions per second (0 = unlimited)")
+        sub.add_argument("--timeout", type=float, default=30, help="seconds to wait for any single reply")
+        sub.add_argument("--start-server", action="store_true", help="start the server locally on --port")
+        if mode == "ws":
+            sub.add_argument("--batch", type=int, default=1, help="negotiate batches of up to N messages per frame")
+        else:
+            sub.add_argument("--flow", choices=("workflow", "stream"), default="workflow")
+
+    args = parser.parse_args()
+    if args.mode is None:
         asyncio.run(main())
+        return
+    if not args.sessions and not args.duration:
+        args.sessions = args.concurrency
+    asyncio.run(load_test(args))
+
+if __name__ == "__main__":
+    try:
+        cli()
     except KeyboardInterrupt:
         print("\n🛑 Test interrupted by user")
     except Exception as e:
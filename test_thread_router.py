@@ -0,0 +1,21 @@
+from thread_router import ThreadRouter
+
+
+def test_zero_padded_shard_id_is_canonical(tmp_path):
+    router = ThreadRouter(enabled=True, socket_dir=str(tmp_path), workers=4, shard_id="01")
+    assert router.shard_id == "1"
+
+    thread_id = router.new_thread_id()
+    assert thread_id.startswith("1.")
+    assert router.owner(thread_id) == "1"
+    assert router.is_local(thread_id)
+    assert router.is_local("01." + thread_id.partition(".")[2])
+    assert not router.is_local("2." + thread_id.partition(".")[2])
+    assert router.socket_path(router.shard_id) == str(tmp_path / "shard-1.sock")
+
+
+def test_invalid_prefix_is_local_and_unowned(tmp_path):
+    router = ThreadRouter(enabled=True, socket_dir=str(tmp_path), workers=2, shard_id="0")
+    for thread_id in ("2.abc", "+1.abc", "../x.abc", "abc"):
+        assert router.owner(thread_id) is None
+        assert router.is_local(thread_id)
@@ -0,0 +1,264 @@
+"""
+Sticky thread routing for running main.py with several workers.
+
+Conversations, workflow jobs and event logs live in the memory of the worker
+that created them. With routing enabled each worker claims a shard number
+and thread_ids carry it (``3.<uuid>``). Whichever worker the kernel hands a
+request to looks at the thread_id: requests for its own threads run locally,
+and the rest are forwarded over a Unix socket to the owning worker, which
+also serves the app on ``SHARD_DIR/shard-<n>.sock``. A thread's state
+therefore stays in one process and is read from memory, not from a shared
+store on every call.
+
+thread_ids come from clients, so a shard prefix is only trusted when it is
+a shard number in range; anything else is handled as an unknown, local
+thread and never picks a socket path.
+
+Shard numbers are claimed with a lock file per slot, so a worker that
+restarts takes over the slot (and the threads) of the one that died. If the
+owner's socket is gone, the request is served locally instead, which works
+when conversations are kept in a shared store (CONVERSATION_STORE=sqlite).
+
+    THREAD_ROUTING  1 to enable (set automatically when main.py runs with WORKERS > 1)
+    WORKERS         number of shards, 0 to WORKERS - 1 (set it to the gunicorn worker count too)
+    SHARD_ID        fixed shard number for this process (default: first free slot)
+    SHARD_DIR       directory for the shard sockets and lock files (default <tmp>/thread-shards)
+"""
+
+import asyncio
+import fcntl
+import os
+import tempfile
+from typing import Dict, Iterable, List, Optional
+from uuid import uuid4
+
+import aiohttp
+import uvicorn
+
+import json_codec
+
+# Set on forwarded requests, so the owner never forwards them again
+FORWARDED_HEADER = b"x-thread-shard"
+# Hop-by-hop headers are not copied between the two connections
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "host", "upgrade"}
+
+
+class ShardServer(uvicorn.Server):
+    """Second listener inside a worker; the main server already owns the signal handlers."""
+
+    def install_signal_handlers(self):
+        pass
+
+
+class ThreadRouter:
+    def __init__(self, enabled: bool, socket_dir: str, workers: int = 1, shard_id: Optional[str] = None):
+        self.enabled = enabled
+        self.socket_dir = socket_dir
+        self.workers = workers
+        if shard_id is not None and not self.is_shard(shard_id):
+            raise ValueError(f"SHARD_ID must be between 0 and {workers - 1}, got {shard_id!r}")
+        # Canonical form ("01" -> "1"), the same one owner() returns
+        self.shard_id = str(int(shard_id)) if shard_id is not None else None
+        self.sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._server: Optional[ShardServer] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock_file = None
+
+    def socket_path(self, shard_id: str) -> str:
+        return os.path.join(self.socket_dir, f"shard-{shard_id}.sock")
+
+    def new_thread_id(self) -> str:
+        if not self.enabled:
+            return str(uuid4())
+        return f"{self.shard_id}.{uuid4()}"
+
+    def is_shard(self, shard_id: str) -> bool:
+        # Plain decimal digits only ("+1", " 1" and "١" all pass int())
+        return shard_id.isascii() and shard_id.isdigit() and int(shard_id) < self.workers
+
+    def owner(self, thread_id: str) -> Optional[str]:
+        """Shard that owns ``thread_id``, or None for ids created without routing or with an invalid shard."""
+        shard_id, dot, _ = thread_id.partition(".")
+        if not dot or not self.is_shard(shard_id):
+            return None
+        return str(int(shard_id))  # "01" and "1" are the same shard and socket
+
+    def is_local(self, thread_id: str) -> bool:
+        owner = self.owner(thread_id)
+        return owner is None or owner == self.shard_id
+
+    async def start(self, app):
+        """Claim a shard and serve ``app`` on its socket; call from the startup hook."""
+        if not self.enabled or self._task is not None:
+            return
+        os.makedirs(self.socket_dir, exist_ok=True)
+        if self.shard_id is None:
+            self.shard_id = self._claim_slot()
+        path = self.socket_path(self.shard_id)
+        if os.path.exists(path):
+            os.unlink(path)  # left behind by the slot's previous owner
+        config = uvicorn.Config(app, uds=path, lifespan="off", log_config=None, access_log=False)
+        self._server = ShardServer(config)
+        self._task = asyncio.create_task(self._server.serve())
+        while not self._server.started and not self._task.done():
+            await asyncio.sleep(0.01)
+
+    def _claim_slot(self) -> str:
+        for slot in range(self.workers):
+            lock_file = open(os.path.join(self.socket_dir, f"shard-{slot}.lock"), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            self._lock_file = lock_file  # held until the process exits
+            return str(slot)
+        raise RuntimeError(f"All {self.workers} shard slots in {self.socket_dir} are taken; raise WORKERS")
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+        if self._server is not None:
+            self._server.should_exit = True
+            await self._task
+            self._server = self._task = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def session(self, shard_id: str) -> aiohttp.ClientSession:
+        # One keep-alive pool per owner shard
+        session = self.sessions.get(shard_id)
+        if session is None or session.closed:
+            session = self.sessions[shard_id] = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(path=self.socket_path(shard_id)),
+                auto_decompress=False,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=5)
+            )
+        return session
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "shard_id": self.shard_id,
+            "workers": self.workers,
+            "socket": self.socket_path(self.shard_id) if self.enabled and self.shard_id is not None else None,
+        }
+
+
+class ThreadRoutingMiddleware:
+    """ASGI middleware sending each thread's requests to the worker that owns it.
+
+    The thread_id is the last path segment for routes under ``path_prefixes``
+    and the ``thread_id`` field of the JSON body for ``body_paths``. Other
+    requests are never forwarded. Bodies of routed requests are read up
+    front; they are small JSON documents.
+    """
+
+    def __init__(self, app, router: ThreadRouter, routed, path_prefixes: Iterable[str] = (), body_paths: Iterable[str] = ()):
+        self.app = app
+        self.router = router
+        self.path_prefixes = tuple(path_prefixes)
+        self.body_paths = frozenset(body_paths)
+        self.local, self.forwarded, self.fallback = routed.labels("local"), routed.labels("forwarded"), routed.labels("fallback")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.router.enabled:
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        routed_by_body = path in self.body_paths
+        if not routed_by_body and not path.startswith(self.path_prefixes):
+            await self.app(scope, receive, send)
+            return
+        if any(name == FORWARDED_HEADER for name, _ in scope["headers"]):
+            await self.app(scope, receive, send)
+            return
+
+        body = await read_body(receive)
+        thread_id = self.thread_id_from_body(body) if routed_by_body else path.rstrip("/").rsplit("/", 1)[-1]
+        replay = replay_body(body, receive)
+        if thread_id is None or self.router.is_local(thread_id):
+            self.local.inc()
+            await self.app(scope, replay, send)
+            return
+
+        try:
+            await self.forward(self.router.owner(thread_id), scope, body, send)
+            self.forwarded.inc()
+        except (aiohttp.ClientConnectorError, FileNotFoundError):
+            # Owner is not running: serve from whatever the shared store has
+            self.fallback.inc()
+            await self.app(scope, replay, send)
+
+    def thread_id_from_body(self, body: bytes) -> Optional[str]:
+        try:
+            thread_id = json_codec.loads(body).get("thread_id")
+        except (ValueError, AttributeError):
+            return None  # let the endpoint report the bad request
+        return thread_id if isinstance(thread_id, str) else None
+
+    async def forward(self, shard_id: str, scope, body: bytes, send):
+        headers = [
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in scope["headers"] if name.decode("latin-1") not in HOP_HEADERS
+        ]
+        headers.append((FORWARDED_HEADER.decode(), self.router.shard_id))
+        url = "http://shard" + (scope.get("raw_path") or scope["path"].encode()).decode("latin-1")
+        if scope["query_string"]:
+            url += "?" + scope["query_string"].decode("latin-1")
+        # Connection errors are raised before anything is sent to the client,
+        # so the caller can still fall back to serving locally
+        async with self.router.session(shard_id).request(scope["method"], url, headers=headers, data=body or None) as response:
+            await send({
+                "type": "http.response.start",
+                "status": response.status,
+                "headers": [
+                    (name, value) for name, value in response.raw_headers
+                    if name.decode("latin-1").lower() not in HOP_HEADERS
+                ],
+            })
+            # Streamed responses (NDJSON) are relayed chunk by chunk
+            async for chunk in response.content.iter_any():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def read_body(receive) -> bytes:
+    chunks: List[bytes] = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+def replay_body(body: bytes, receive):
+    """A receive callable that hands out the already-read body, then the connection's own messages (disconnect)."""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
+
+
+def create_thread_router() -> ThreadRouter:
+    """Build the router configured by THREAD_ROUTING, WORKERS, SHARD_ID and SHARD_DIR."""
+    return ThreadRouter(
+        enabled=os.environ.get("THREAD_ROUTING", "0").lower() in ("1", "true", "yes"),
+        socket_dir=os.environ.get("SHARD_DIR", os.path.join(tempfile.gettempdir(), "thread-shards")),
+        workers=int(os.environ.get("WORKERS", 1)),
+        shard_id=os.environ.get("SHARD_ID") or None
+    )
+
+
+thread_router = create_thread_router()
@@ -0,0 +1,187 @@
+"""
+Small stage-DAG scheduler for the agent pipeline.
+
+Each stage declares the stages (or seed inputs) it depends on. Every stage
+whose inputs are ready runs concurrently, and results are yielded as soon as
+each one finishes, so end-to-end latency follows the critical path instead of
+the sum of all stages.
+
+Stage outputs are frozen (see ``freeze``) as they complete: the same object
+is handed to downstream stages, streamed to the client and merged into the
+final result, so nothing may modify it, and its JSON encoding is computed
+once and reused.
+
+A stage function may also be an async generator, for agents that stream
+their output: every ``str`` it yields is a chunk of text, reported as a
+StageDelta when the caller asks for deltas, and a non-``str`` value it
+yields is the stage result. Without one, the result is the joined text.
+"""
+
+import asyncio
+import inspect
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import json_codec
+
+StageFn = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class Stage(NamedTuple):
+    name: str
+    fn: StageFn
+    deps: Tuple[str, ...] = ()
+
+
+class StageResult(NamedTuple):
+    stage: str
+    data: Any
+
+
+class StageDelta(NamedTuple):
+    """A chunk of text a streaming stage produced before its result."""
+    stage: str
+    text: str
+
+
+class FrozenDict(dict):
+    """Read-only dict that caches its own JSON encoding."""
+
+    __slots__ = ("_encoded",)
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Stage outputs are read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    @property
+    def encoded(self) -> bytes:
+        """The compact JSON encoding, computed on first use."""
+        try:
+            return self._encoded
+        except AttributeError:
+            self._encoded = json_codec.dumps(self)
+            return self._encoded
+
+
+def freeze(value: Any) -> Any:
+    """Return a deeply read-only copy: dicts become FrozenDicts, lists tuples."""
+    if isinstance(value, FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def encode_frozen(value: Any) -> bytes:
+    """JSON-encode ``value``, reusing the cached encoding of a FrozenDict."""
+    if isinstance(value, FrozenDict):
+        return value.encoded
+    return json_codec.dumps(value)
+
+
+def validate_stages(stages: Sequence[Stage], inputs: Iterable[str] = ()) -> None:
+    """Raise ValueError for duplicate names, unknown dependencies or cycles."""
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate stage names: {names}")
+
+    available = set(inputs)
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining if all(dep in available for dep in stage.deps)]
+        if not ready:
+            missing = {stage.name: [dep for dep in stage.deps if dep not in available] for stage in remaining}
+            raise ValueError(f"Unsatisfiable stage dependencies: {missing}")
+        available.update(stage.name for stage in ready)
+        remaining = [stage for stage in remaining if stage not in ready]
+
+
+async def collect_stream(stream: AsyncIterator[Any], emit: Callable[[str], None]) -> Any:
+    """Drive a streaming stage: pass each text chunk to ``emit`` and return the result."""
+    chunks: List[str] = []
+    result = None
+    async for item in stream:
+        if isinstance(item, str):
+            chunks.append(item)
+            emit(item)
+        else:
+            result = item
+    return result if result is not None else "".join(chunks)
+
+
+async def run_stages(
+    stages: Sequence[Stage],
+    inputs: Optional[Dict[str, Any]] = None,
+    deltas: bool = False,
+) -> AsyncIterator[Union[StageResult, StageDelta]]:
+    """Run ``stages`` as a DAG and yield a StageResult as each one finishes.
+
+    ``inputs`` seeds values that stages may depend on without being stages
+    themselves (e.g. the clarifier output). Each stage function receives a
+    dict holding only the outputs of its declared dependencies; each output
+    is frozen before it is shared or yielded. With ``deltas``, the text
+    chunks of streaming stages are yielded as StageDeltas as they arrive,
+    always before that stage's result. If a stage fails, or the consumer
+    stops iterating, the stages still running are cancelled.
+    """
+    results: Dict[str, Any] = dict(inputs or {})
+    validate_stages(stages, results)
+
+    order = {stage.name: index for index, stage in enumerate(stages)}
+    pending = list(stages)
+    running: Dict[asyncio.Future, Stage] = {}
+    emitted: List[StageDelta] = []
+    delta_ready = asyncio.Event()
+
+    def start(stage: Stage) -> asyncio.Future:
+        output = stage.fn({dep: results[dep] for dep in stage.deps})
+        if inspect.isasyncgen(output):
+            def emit(text: str):
+                if deltas:
+                    emitted.append(StageDelta(stage.name, text))
+                    delta_ready.set()
+            output = collect_stream(output, emit)
+        return asyncio.ensure_future(output)
+
+    waiter: Optional[asyncio.Future] = None
+    try:
+        while pending or running:
+            for stage in [stage for stage in pending if all(dep in results for dep in stage.deps)]:
+                pending.remove(stage)
+                running[start(stage)] = stage
+
+            wait_for = list(running)
+            if deltas:
+                waiter = asyncio.ensure_future(delta_ready.wait())
+                wait_for.append(waiter)
+            done, _ = await asyncio.wait(wait_for, return_when=asyncio.FIRST_COMPLETED)
+            if waiter is not None:
+                waiter.cancel()
+                done.discard(waiter)
+
+            # Deltas first: a stage's chunks always precede its result
+            if emitted:
+                batch = emitted[:]
+                emitted.clear()
+                delta_ready.clear()
+                for delta in batch:
+                    yield delta
+
+            # Keep declaration order among stages that finished together
+            for task in sorted(done, key=lambda t: order[running[t].name]):
+                stage = running.pop(task)
+                results[stage.name] = freeze(task.result())
+                yield StageResult(stage.name, results[stage.name])
+    finally:
+        if waiter is not None:
+            waiter.cancel()
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)